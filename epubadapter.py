@@ -1,11 +1,16 @@
-from gi.repository import GObject
 import logging
+import os
 
 import epubview
+from readcache import trim_book_data
+from readdb import FullTextIndex
+from speechtoolbar import get_marked_words
+from speechtoolbar import SPEECH_WINDOW_SIZE
+from speechtoolbar import split_words
 
 # import speech
 
-from io import StringIO
+import xml.etree.ElementTree as etree
 
 _logger = logging.getLogger('read-activity')
 
@@ -16,30 +21,46 @@ class EpubViewer(epubview.EpubView):
         epubview.EpubView.__init__(self)
 
     def setup(self, activity):
+        self._activity = activity
         self.set_screen_dpi(activity.dpi)
         self.connect('selection-changed',
                      activity._view_selection_changed_cb)
+        self.connect('pagecount-changed',
+                     activity._view_pagecount_changed_cb)
+        self.connect('file-loaded', self._file_loaded_cb)
 
         activity._hbox.pack_start(self, True, True, 0)
         self.show_all()
-        self._modified_files = []
 
         # text to speech initialization
         self.current_word = 0
-        self.word_tuples = []
+        self._fulltext_index = None
 
     def load_document(self, file_path):
-        self.set_document(EpubDocument(self, file_path.replace('file://', '')))
+        filehash = self._activity.filehash
+        cache_path = os.path.join(self._activity.get_activity_root(), 'data',
+                                  filehash + '.epubpages')
+        trim_book_data(cache_path)
+        self.set_document(EpubDocument(self, file_path.replace('file://', '')),
+                          cache_path, {'filehash': filehash})
+        self._fulltext_index = FullTextIndex(self._activity.filehash)
+        self._fulltext_index.build(self._epub.iter_texts())
         # speech.highlight_cb = self.highlight_next_word
         # speech.reset_cb = self.reset_text_to_speech
         # speech.end_text_cb = self.get_more_text
 
+    def _destroy_cb(self, widget):
+        # the book is closed by EpubView, the indexing must be stopped
+        if self._fulltext_index is not None:
+            self._fulltext_index.cancel()
+        epubview.EpubView._destroy_cb(self, widget)
+
     def load_metadata(self, activity):
 
         self.metadata = activity.metadata
 
         if not self.metadata['title_set_by_user'] == '1':
-            title = self._epub._info._get_title()
+            title = self._epub.get_info()
             if title:
                 self.metadata['title'] = title
         if 'Read_zoom' in self.metadata:
@@ -69,100 +90,60 @@ class EpubViewer(epubview.EpubView):
         return True
 
     def show_highlights(self, page):
-        # we save the highlights in the page as html
+        # the highlights are shown when every file is loaded
         pass
 
-    def toggle_highlight(self, highlight):
-        self._view.set_editable(True)
+    def _file_loaded_cb(self, view, filename):
+        self._show_file_highlights()
+
+    def _get_file_highlights(self):
+        # the highlights are stored by file, using the position
+        # of the file in the flat toc like a page
+        try:
+            file_index = self._epub.get_flattoc().index(self._loaded_filename)
+        except ValueError:
+            return None
+        return file_index, \
+            self._activity._bookmarkmanager.get_highlights(file_index)
 
+    def _show_file_highlights(self):
+        file_highlights = self._get_file_highlights()
+        if file_highlights is not None:
+            self._view.set_highlights(list(file_highlights[1]))
+
+    def toggle_highlight(self, highlight):
+        file_highlights = self._get_file_highlights()
+        if file_highlights is None:
+            return
+        file_index = file_highlights[0]
+        bookmarkmanager = self._activity._bookmarkmanager
         if highlight:
-            js = 'document.execCommand("backColor", false, "yellow");'
+            selection = self._view.get_selection_offsets()
+            if selection is None or selection[0] == selection[1]:
+                return
+            bookmarkmanager.add_highlight(file_index, selection)
         else:
-            # need remove the highlight nodes
-            js = '''
-(function(){
-    var selObj = window.getSelection();
-    if (selObj.rangeCount < 1)
-        return;
-    var range  = selObj.getRangeAt(0);
-    var node = range.startContainer;
-    while (node.parentNode != null) {
-      if (node.localName == "span") {
-        if (node.hasAttributes()) {
-          var attrs = node.attributes;
-          for (var i = attrs.length - 1; i >= 0; i--) {
-            if (attrs[i].name == "style" &&
-                attrs[i].value == "background-color: yellow;") {
-              node.removeAttribute("style");
-              break;
-            };
-          };
-        };
-      };
-      node = node.parentNode;
-    };
-}())
-            '''
-
-        self._view.run_javascript(js)
-
-        self._view.set_editable(False)
-        # mark the file as modified
-        current_file = self.get_current_file()
-        logging.error('file %s was modified', current_file)
-        if current_file not in self._modified_files:
-            self._modified_files.append(current_file)
-        GObject.idle_add(self._save_page)
-
-    def _save_page(self):
-        html = self._view._execute_script_sync(
-            "document.documentElement.innerHTML")
-        file_path = self.get_current_file().replace('file:///', '/')
-        logging.error(html)
-        with open(file_path, 'w') as fd:
-            header = """<?xml version="1.0" encoding="utf-8" standalone="no"?>
-                <!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.1//EN"
-                 "http://www.w3.org/TR/xhtml11/DTD/xhtml11.dtd">
-                <html xmlns="http://www.w3.org/1999/xhtml">"""
-            fd.write(header)
-            fd.write(html)
-            fd.write('</html>')
+            in_bounds, highlight_found = self.in_highlight()
+            if not in_bounds:
+                return
+            bookmarkmanager.del_highlight(file_index, highlight_found)
+        self._show_file_highlights()
 
     def save(self, file_path):
-        if self._modified_files:
-            self._epub.write(file_path)
-            return True
-
+        # the highlights are stored in the database,
+        # the book is not modified
         return False
 
     def in_highlight(self):
         # Verify if the selection already exist or the cursor
-        # is in a highlighted area
-        return self._view._execute_script_sync(
-            """
-(function(){
-    var selObj = window.getSelection();
-    if (selObj.rangeCount < 1)
-        return false;
-    var range  = selObj.getRangeAt(0);
-    var node = range.startContainer;
-    while (node.parentNode != null) {
-      if (node.localName == "span") {
-        if (node.hasAttributes()) {
-          var attrs = node.attributes;
-          for(var i = attrs.length - 1; i >= 0; i--) {
-            if (attrs[i].name == "style" &&
-                attrs[i].value == "background-color: yellow;") {
-              return true;
-            };
-          };
-        };
-      };
-      node = node.parentNode;
-    };
-    return false;
-})()
-        """) == "true", None
+        # is in a highlighted area, the web view updates the selection
+        # when it changes
+        selection = self._view.get_selection_offsets()
+        file_highlights = self._get_file_highlights()
+        if selection is None or file_highlights is None:
+            return False, None
+        highlight_found = file_highlights[1].find(selection[0], selection[1])
+        return highlight_found is not None, highlight_found
 
     def can_do_text_to_speech(self):
         return False
@@ -170,26 +151,32 @@ class EpubViewer(epubview.EpubView):
     def can_rotate(self):
         return False
 
+    def get_speech_words(self):
+        '''
+        Returns the text prepared for the text to speech,
+        and two arrays with the start and end offsets of the words
+        '''
+        if self._speech_words is None:
+            self._speech_words = split_words(self._speech_text)
+        return (self._speech_text, ) + self._speech_words
+
     def get_marked_words(self):
-        "Adds a mark between each word of text."
-        i = self.current_word
-        file_str = StringIO()
-        file_str.write('<speak> ')
-        end_range = i + 40
-        if end_range > len(self.word_tuples):
-            end_range = len(self.word_tuples)
-        for word_tuple in self.word_tuples[self.current_word:end_range]:
-            file_str.write('<mark name="' + str(i) + '"/>' +
-                           word_tuple[2].encode('utf-8'))
-            i = i + 1
-        self.current_word = i
-        file_str.write('</speak>')
-        return file_str.getvalue()
+        '''
+        Returns the next words to speak, with a mark between each word,
+        or None if all the text was spoken
+        '''
+        text, starts, ends = self.get_speech_words()
+        if self.current_word >= len(starts):
+            return None
+        marked_words = get_marked_words(text, starts, ends,
+                                        self.current_word)
+        self.current_word = self.current_word + SPEECH_WINDOW_SIZE
+        return marked_words
 
     def get_more_text(self):
         pass
         """
-        if self.current_word < len(self.word_tuples):
+        if self.current_word < len(self.get_speech_words()[1]):
             speech.stop()
             more_text = self.get_marked_words()
             speech.play(more_text)
@@ -220,13 +207,6 @@ class EpubViewer(epubview.EpubView):
     def connect_page_changed_handler(self, handler):
         self.connect('page-changed', handler)
 
-    def _try_load_page(self, n):
-        if self._ready:
-            self._load_page(n)
-            return False
-        else:
-            return True
-
     def set_screen_dpi(self, dpi):
         return
 
@@ -234,42 +214,38 @@ class EpubViewer(epubview.EpubView):
         pass
 
     def set_current_page(self, n):
-        # When the book is being loaded, calling this does not help
-        # In such a situation, we go into a loop and try to load the
-        # supplied page when the book has loaded completely
+        # When the book is being loaded, the page is loaded
+        # as soon as the pages are estimated
         n += 1
         if self._ready:
             self._load_page(n)
         else:
-            GObject.timeout_add(200, self._try_load_page, n)
+            self._pending_page = n
 
     def get_current_page(self):
         return int(self._loaded_page) - 1
 
     def get_current_link(self):
-        # the _loaded_filename include all the path,
-        # need only the part included in the link
-        return self._loaded_filename[len(self._epub._tempdir) + 1:]
+        # the _loaded_filename is the path of the file in the epub,
+        # like the links
+        return self._loaded_filename
 
     def update_toc(self, activity):
         if self._epub.has_document_links():
+            # the model is created when the navigator is shown
             activity.show_navigator_button()
-            activity.set_navigator_model(self._epub.get_links_model())
             return True
         else:
             return False
 
+    def get_toc_model(self):
+        return self._epub.get_links_model()
+
     def get_link_iter(self, current_link):
         """
         Returns the iter related to a link
         """
-        link_iter = self._epub.get_links_model().get_iter_first()
-
-        while link_iter is not None and \
-                self._epub.get_links_model().get_value(link_iter, 1) \
-                != current_link:
-            link_iter = self._epub.get_links_model().iter_next(link_iter)
-        return link_iter
+        return self._epub.get_link_iter(current_link)
 
     def find_changed(self, job, page=None):
         self._find_changed(job)
@@ -280,7 +256,8 @@ class EpubViewer(epubview.EpubView):
     def setup_find_job(self, text, updated_cb):
         self._find_job = JobFind(document=self._epub,
                                  start_page=0, n_pages=self.get_pagecount(),
-                                 text=text, case_sensitive=False)
+                                 text=text, case_sensitive=False,
+                                 fulltext_index=self._fulltext_index)
         self._find_updated_handler = self._find_job.connect('updated',
                                                             updated_cb)
         return self._find_job, self._find_updated_handler
@@ -296,15 +273,30 @@ class EpubDocument(epubview.Epub):
         return int(self._page_cache.get_pagecount())
 
     def has_document_links(self):
-        return True
+        return self.has_toc()
 
     def get_links_model(self):
         return self.get_toc_model()
 
+    def iter_texts(self):
+        '''
+        Yields (n, text) tuples with the text of every file
+        in the flat toc, used to create the full text index
+        '''
+        for n, entry in enumerate(self.get_flattoc()):
+            try:
+                text = self.get_text(entry)
+            except (IOError, ValueError, etree.ParseError) as e:
+                # ValueError if the book was closed
+                _logger.error('Can not get the text of %s: %s', entry, e)
+                text = ''
+            yield n, text
+
 
 class JobFind(epubview.JobFind):
 
     def __init__(self, document, start_page, n_pages, text,
-                 case_sensitive=False):
+                 case_sensitive=False, fulltext_index=None):
         epubview.JobFind.__init__(self, document, start_page, n_pages, text,
-                                  case_sensitive=False)
+                                  case_sensitive=False,
+                                  fulltext_index=fulltext_index)
@@ -0,0 +1,68 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+'''
+Reads the text of the xhtml files of the books.
+
+Only uses the standard library, because is also run as a script,
+in the processes reading the files of a book while searching:
+
+    python bodytext.py <epub file>
+
+reads a json list with the files of the epub from the standard input,
+and writes a json line with the text, or the error, of every file.
+'''
+
+import io
+import json
+import sys
+import zipfile
+import xml.etree.ElementTree as etree
+import html.entities as html_entities
+
+# the dtd of the xhtml files is not read, the parser needs the html entities
+_HTML_ENTITIES = dict((name, chr(codepoint)) for name, codepoint
+                      in html_entities.name2codepoint.items())
+
+
+def get_body_text(data):
+    '''
+    Returns the text in the body of the content of a xhtml file
+    '''
+    parser = etree.XMLParser()
+    parser.entity.update(_HTML_ENTITIES)
+    root = etree.parse(io.BytesIO(data), parser=parser).getroot()
+
+    for child in root:
+        if child.tag.endswith('body'):
+            return ''.join(child.itertext())
+    return ''
+
+
+def _read_texts(file_path):
+    # all the request is read before writing, the process reading the
+    # results does not block writing the request
+    entries = json.loads(sys.stdin.read())
+    with zipfile.ZipFile(file_path) as zip_file:
+        for entry in entries:
+            try:
+                result = {'text': get_body_text(zip_file.read(entry))}
+            except (IOError, KeyError, etree.ParseError) as e:
+                result = {'error': str(e)}
+            sys.stdout.write(json.dumps(result) + '\n')
+            sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    _read_texts(sys.argv[1])
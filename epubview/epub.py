@@ -16,14 +16,37 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 import zipfile
-import tempfile
 import os
+import itertools
+import mimetypes
 import xml.etree.ElementTree as etree
-import shutil
-import logging
+from urllib.parse import quote
+from urllib.parse import unquote
+from urllib.parse import urlsplit
 
 from . import navmap
 from . import epubinfo
+from .bodytext import get_body_text
+
+# the files of the books are loaded in the web views from the zip,
+# using uris like epub://<book>/<path of the file in the zip>
+URI_SCHEME = 'epub'
+
+_documents = {}
+_document_ids = itertools.count()
+
+_OPF_NS = '{http://www.idpf.org/2007/opf}'
+
+
+def get_document(uri):
+    '''
+    Returns the Epub and the name of the file requested by the uri,
+    or (None, None) if the book is not open
+    '''
+    parts = urlsplit(uri)
+    if parts.scheme != URI_SCHEME:
+        return None, None
+    return _documents.get(parts.netloc), unquote(parts.path[1:])
 
 
 class _Epub(object):
@@ -37,41 +60,20 @@ class _Epub(object):
         self._opfpath = None
         self._ncxpath = None
         self._basepath = None
-        self._tempdir = tempfile.mkdtemp()
+        self._texts = {}
+        self._uri_host = 'book%d' % next(_document_ids)
 
         if not self._verify():
             print('Warning: This does not seem to be a valid epub file')
 
         self._get_opf()
-        self._get_ncx()
+        flattoc = self._parse_opf()
 
         ncxfile = self._zobject.open(self._ncxpath)
-        opffile = self._zobject.open(self._opfpath)
-        self._navmap = navmap.NavMap(opffile, ncxfile, self._basepath)
+        self._navmap = navmap.NavMap(ncxfile, self._basepath, flattoc)
+        ncxfile.close()
 
-        opffile = self._zobject.open(self._opfpath)
-        self._info = epubinfo.EpubInfo(opffile)
-
-        self._unzip()
-
-    def _unzip(self):
-        # This is broken upto python 2.7
-        # self._zobject.extractall(path = self._tempdir)
-        orig_cwd = os.getcwd()
-        os.chdir(self._tempdir)
-        for name in self._zobject.namelist():
-            # Some weird zip file entries start with a slash,
-            # and we don't want to write to the root directory
-            try:
-                if name.startswith(os.path.sep):
-                    name = name[1:]
-                if name.endswith(os.path.sep) or name.endswith('\\'):
-                    os.makedirs(name)
-            except:
-                logging.error('ERROR unziping %s', name)
-            else:
-                self._zobject.extract(name)
-        os.chdir(orig_cwd)
+        _documents[self._uri_host] = self
 
     def _get_opf(self):
         containerfile = self._zobject.open('META-INF/container.xml')
@@ -91,20 +93,43 @@ class _Epub(object):
 
         containerfile.close()
 
-    def _get_ncx(self):
-        opffile = self._zobject.open(self._opfpath)
+    def _parse_opf(self):
+        '''
+        Reads the metadata, the manifest and the spine in a single pass
+        over the opf file, clearing the elements when they are read.
+        Returns the flat toc.
+        '''
+        itemmap = {}
+        itemrefs = []
+        tocid = None
+        self._info = None
 
-        tree = etree.parse(opffile)
-        root = tree.getroot()
+        opffile = self._zobject.open(self._opfpath)
+        for event, element in etree.iterparse(opffile):
+            if element.tag == _OPF_NS + 'item':
+                itemmap[element.get('id')] = element.get('href')
+                element.clear()
+            elif element.tag == _OPF_NS + 'itemref':
+                itemrefs.append(element.get('idref'))
+                element.clear()
+            elif element.tag == _OPF_NS + 'spine':
+                tocid = element.get('toc')
+                element.clear()
+            elif element.tag == _OPF_NS + 'manifest':
+                element.clear()
+            elif element.tag == _OPF_NS + 'metadata':
+                self._info = epubinfo.EpubInfo(element)
+                element.clear()
+        opffile.close()
 
-        spine = root.find('.//{http://www.idpf.org/2007/opf}spine')
-        tocid = spine.get('toc')
+        if self._info is None:
+            self._info = epubinfo.EpubInfo(
+                etree.Element(_OPF_NS + 'metadata'))
 
-        for element in root.iterfind('.//{http://www.idpf.org/2007/opf}item'):
-            if element.get('id') == tocid:
-                self._ncxpath = self._basepath + element.get('href')
+        if tocid in itemmap:
+            self._ncxpath = self._basepath + itemmap[tocid]
 
-        opffile.close()
+        return [self._basepath + itemmap[idref] for idref in itemrefs]
 
     def _verify(self):
         '''
@@ -136,6 +161,19 @@ class _Epub(object):
         '''
         return self._navmap.get_gtktreestore()
 
+    def has_toc(self):
+        '''
+        Returns True if the Epub has a table of contents
+        '''
+        return self._navmap.has_navpoints()
+
+    def get_link_iter(self, link):
+        '''
+        Returns the iter of the link in the table of contents
+        model, or None if the link is not in the model
+        '''
+        return self._navmap.get_link_iter(link)
+
     def get_flattoc(self):
         '''
         Returns a flat (linear) list of files to be
@@ -143,12 +181,82 @@ class _Epub(object):
         '''
         return self._navmap.get_flattoc()
 
-    def get_basedir(self):
+    def get_text(self, entry):
+        '''
+        Returns the text in the body of a file of the flat toc,
+        the text is read once and kept to search in the book
+        '''
+        if entry not in self._texts:
+            self._texts[entry] = self._read_text(entry)
+        return self._texts[entry]
+
+    def _read_text(self, entry):
+        return get_body_text(self.read_file(entry))
+
+    def has_text(self, entry):
+        '''
+        Returns True if the text of a file was read
+        '''
+        return entry in self._texts
+
+    def set_text(self, entry, text):
+        '''
+        Keeps the text of a file, read by get_body_text() in other process
+        '''
+        self._texts[entry] = text
+
+    def get_uri(self, entry):
+        '''
+        Returns the uri used to load a file of the epub in the web views
+        '''
+        return '%s://%s/%s' % (URI_SCHEME, self._uri_host, quote(entry))
+
+    def get_entry(self, uri):
         '''
-        Returns the base directory where the contents of the
-        epub has been unzipped
+        Returns the file of the epub loaded from the uri,
+        without the anchor, or None if the uri is not from this epub
         '''
-        return self._tempdir
+        document, entry = get_document(uri.split('#')[0])
+        if document is not self:
+            return None
+        return entry
+
+    def get_file_path(self):
+        '''
+        Returns the path of the epub file, or None if the epub
+        was opened from a file object
+        '''
+        if not isinstance(self._file, str):
+            return None
+        return self._file
+
+    def read_file(self, entry):
+        '''
+        Returns the content of a file of the epub.
+        Raises KeyError if the file does not exist.
+        '''
+        return self._zobject.read(entry)
+
+    def get_file_size(self, entry):
+        '''
+        Returns the size of a file of the epub, or 0 if it does not exist
+        '''
+        try:
+            return self._zobject.getinfo(entry).file_size
+        except KeyError:
+            return 0
+
+    def get_mimetype(self, entry):
+        '''
+        Returns the mime type used to load a file in the web views
+        '''
+        if entry.endswith('.xml'):
+            # load the xml files as xhtml to make javascript work
+            return 'application/xhtml+xml'
+        mimetype = mimetypes.guess_type(entry)[0]
+        if mimetype is None:
+            return 'application/octet-stream'
+        return mimetype
 
     def get_info(self):
         '''
@@ -156,47 +264,11 @@ class _Epub(object):
         '''
         return self._info.title
 
-    def write(self, file_path):
-        '''Create the ZIP archive.
-        The mimetype must be the first file in the archive
-        and it must not be compressed.'''
-
-        # The EPUB must contain the META-INF and mimetype files at the root, so
-        # we'll create the archive in the working directory first
-        # and move it later
-        current_dir = os.getcwd()
-        os.chdir(self._tempdir)
-
-        # Open a new zipfile for writing
-        epub = zipfile.ZipFile(file_path, 'w')
-
-        # Add the mimetype file first and set it to be uncompressed
-        epub.write('mimetype', compress_type=zipfile.ZIP_STORED)
-
-        # For the remaining paths in the EPUB, add all of their files
-        # using normal ZIP compression
-        self._scan_dir('.', epub)
-
-        epub.close()
-        os.chdir(current_dir)
-
-    def _scan_dir(self, path, epub_file):
-        for p in os.listdir(path):
-            logging.error('add file %s', p)
-            if os.path.isdir(os.path.join(path, p)):
-                self._scan_dir(os.path.join(path, p), epub_file)
-            else:
-                if p != 'mimetype':
-                    epub_file.write(
-                        os.path.join(path, p),
-                        compress_type=zipfile.ZIP_DEFLATED)
-
     def close(self):
         '''
-        Cleans up (closes open zip files and deletes
-        uncompressed content of Epub.
+        Cleans up (closes open zip files).
         Please call this when a file is being closed or during
         application exit.
         '''
+        _documents.pop(self._uri_host, None)
         self._zobject.close()
-        shutil.rmtree(self._tempdir)
@@ -1,15 +1,13 @@
-import xml.etree.ElementTree as etree
-
-
 class EpubInfo():
 
     # TODO: Cover the entire DC range
 
-    def __init__(self, opffile):
-        self._tree = etree.parse(opffile)
-        self._root = self._tree.getroot()
-        self._e_metadata = self._root.find(
-            '{http://www.idpf.org/2007/opf}metadata')
+    def __init__(self, metadata):
+        '''
+        metadata: the metadata element of the opf file, it is
+        not kept after reading the data
+        '''
+        self._e_metadata = metadata
 
         self.title = self._get_title()
         self.creator = self._get_creator()
@@ -22,6 +20,8 @@ class EpubInfo():
         self.summary = self._get_description()
         self.cover_image = self._get_cover_image()
 
+        self._e_metadata = None
+
     def _get_data(self, tagname):
         element = self._e_metadata.find(tagname)
         return element.text
@@ -29,12 +29,14 @@ from gi.repository import WebKit2
 from . import widgets
 
 import logging
-import os.path
 import math
 import shutil
 
 from .jobs import _JobPaginator as _Paginator
 
+# milliseconds between the page-changed signals emitted while scrolling
+PAGE_CHANGED_INTERVAL = 100
+
 LOADING_HTML = '''
 <html style="height: 100%; margin: 0; padding: 0; width: 100%;">
     <body style="display: table; height: 100%; margin: 0; padding: 0;
@@ -60,6 +62,10 @@ class _View(Gtk.HBox):
                          ([int, int])),
         'selection-changed': (GObject.SignalFlags.RUN_FIRST, GObject.TYPE_NONE,
                               ([])),
+        'pagecount-changed': (GObject.SignalFlags.RUN_FIRST,
+                              GObject.TYPE_NONE, ([int])),
+        'file-loaded': (GObject.SignalFlags.RUN_FIRST, GObject.TYPE_NONE,
+                        ([str])),
     }
 
     def __init__(self):
@@ -81,26 +87,38 @@ class _View(Gtk.HBox):
         self.scale = 1.0
         self._epub = None
         self._findjob = None
-        self.__in_search = False
-        self.__search_fwd = True
+        self._pending_match = None
+        self._shown_filename = None
         self._filelist = None
         self._internal_link = None
-
-        self._view = widgets._WebView()
+        self._pagination_cache_path = None
+        self._pagination_cache_key = None
+        self._pending_page = None
+        self._page_height = 0
+        self._loading_scrollfactor = 0
+        self._loaded_pagination = None
+        self._loaded_base_height = 0
+        self._standby_filename = None
+        self._standby_size = None
+        self._standby_pagination = None
+        self._standby_base_height = 0
+        self._standby_page_height = None
+        self.__prefetch_backward = False
+        self._page_changed_id = None
+        self._page_changed_from = -1
+        self._speech_text = ''
+        self._speech_words = None
+
+        self._view = self._create_web_view()
         self._view.load_html(LOADING_HTML, '/')
-        settings = self._view.get_settings()
-        settings.props.default_font_family = 'DejaVu LGC Serif'
-        settings.props.enable_plugins = False
-        settings.props.default_charset = 'utf-8'
-        self._view.connect('load-changed', self._view_load_changed_cb)
-        self._view.connect('scrolled', self._view_scrolled_cb)
-        self._view.connect('scrolled-top', self._view_scrolled_top_cb)
-        self._view.connect('scrolled-bottom', self._view_scrolled_bottom_cb)
-        self._view.connect(
-            'selection-changed', self._view_selection_changed_cb)
 
-        find = self._view.get_find_controller()
-        find.connect('failed-to-find-text', self._find_failed_cb)
+        # the next file in the reading direction is loaded in a hidden
+        # view, and the views are swapped when the page is turned
+        self._standby_view = self._create_web_view()
+        self._standby_window = Gtk.Window()
+        self._standby_window.add(self._standby_view)
+        self._standby_window.show_all()
+        self._standby_window.unmap()
 
         self._eventbox = Gtk.EventBox()
         self._eventbox.connect('scroll-event', self._eventbox_scroll_event_cb)
@@ -116,20 +134,40 @@ class _View(Gtk.HBox):
         hbox.pack_end(self._scrollbar, False, True, 0)
 
         self.pack_start(hbox, True, True, 0)
-        self._view.set_can_default(True)
-        self._view.set_can_focus(True)
+
+    def _create_web_view(self):
+        view = widgets._WebView()
+        settings = view.get_settings()
+        settings.props.default_font_family = 'DejaVu LGC Serif'
+        settings.props.enable_plugins = False
+        settings.props.default_charset = 'utf-8'
+        view.connect('load-changed', self._view_load_changed_cb)
+        view.connect('scrolled', self._view_scrolled_cb)
+        view.connect('scrolled-top', self._view_scrolled_top_cb)
+        view.connect('scrolled-bottom', self._view_scrolled_bottom_cb)
+        view.connect('selection-changed', self._view_selection_changed_cb)
+
+        view.set_can_default(True)
+        view.set_can_focus(True)
 
         def map_cp(widget):
             widget.setup_touch()
-            widget.disconnect(self._setup_handle)
+            widget.disconnect(setup_handle)
 
-        self._setup_handle = self._view.connect('map', map_cp)
+        setup_handle = view.connect('map', map_cp)
+        return view
 
-    def set_document(self, epubdocumentinstance):
+    def set_document(self, epubdocumentinstance, pagination_cache_path=None,
+                     pagination_cache_key=None):
         '''
         Sets document (should be a Epub instance)
+        If pagination_cache_path is set, the pagination is stored there
+        and reused when the document is opened again, if the
+        pagination_cache_key (a dict) and the page settings are the same
         '''
         self._epub = epubdocumentinstance
+        self._pagination_cache_path = pagination_cache_path
+        self._pagination_cache_key = pagination_cache_key
         GObject.idle_add(self._paginate)
 
     def do_get_property(self, property):
@@ -163,7 +201,7 @@ class _View(Gtk.HBox):
         Sets the current zoom level
         '''
         scrollbar_pos = self.get_vertical_pos()
-        self._view.set_zoom_level(value / 100.0)
+        self._set_zoom_level(value / 100.0)
         self.set_vertical_pos(scrollbar_pos)
 
     def _get_scale(self):
@@ -331,91 +369,113 @@ class _View(Gtk.HBox):
         Highlights the next matching item for current search
         '''
         self._view.grab_focus()
-        self.__search_fwd = True
-        self._view.get_find_controller().search_next()
+        if self._findjob is not None:
+            self._findjob.find_next()
 
     def find_previous(self):
         '''
         Highlights the previous matching item for current search
         '''
         self._view.grab_focus()
-        self.__search_fwd = False
-        self._view.get_find_controller().search_previous()
-
-    def _find_failed_cb(self, find_controller):
-        try:
-            if self.__search_fwd:
-                path = os.path.join(self._epub.get_basedir(),
-                                    self._findjob.get_next_file())
-            else:
-                path = os.path.join(self._epub.get_basedir(),
-                                    self._findjob.get_prev_file())
-            self.__in_search = True
-            self._load_file(path)
-        except IndexError:
-            # No match anywhere, no other file to pick
-            pass
+        if self._findjob is not None:
+            self._findjob.find_previous()
 
     def _find_changed(self, job):
         self._view.grab_focus()
         self._findjob = job
-        find = self._view.get_find_controller()
-        find.search(self._findjob.get_search_text(),
-                    self._findjob.get_flags(),
-                    GObject.G_MAXUINT)
+        self._pending_match = job.get_current_match()
+        if self._pending_match is None:
+            return
+
+        # the page of the match is estimated by the position in the text
+        # of the file, and updated when the match is selected
+        filename = self._pending_match[0]
+        base_pageno = self._paginator.get_base_pageno_for_file(filename)
+        pages = self._paginator.get_pagecount_for_file(filename)
+        pageno = int(base_pageno) + min(
+            pages - 1, int(pages * job.get_current_scrollfactor()))
+        self._load_page(pageno)
+        if filename == self._shown_filename:
+            self._select_match()
+
+    def _select_match(self):
+        filename, start, end = self._pending_match
+        self._pending_match = None
+        self._view.select_text(start, self._findjob.get_search_text(),
+                               self._match_position_cb, filename)
+
+    def _match_position_cb(self, view, vertical_pos, filename):
+        if filename != self._loaded_filename or view is not self._view or \
+                vertical_pos < 0 or self._page_height == 0:
+            return
+        base_pageno = self._paginator.get_base_pageno_for_file(filename)
+        pages = self._paginator.get_pagecount_for_file(filename)
+        pageno = int(base_pageno) + min(
+            pages - 1, int(pages * vertical_pos / self._page_height))
+        self._load_page(pageno)
 
     def __set_zoom(self, value):
-        self._view.set_zoom_level(value)
+        self._set_zoom_level(value)
         self.scale = value
 
+    def _set_zoom_level(self, value):
+        self._view.set_zoom_level(value)
+        # the file loaded in the hidden view need be measured again
+        self._standby_view.set_zoom_level(value)
+        self._standby_filename = None
+        self._standby_page_height = None
+
     def _view_scrolled_cb(self, view, scrollval):
-        if self._loaded_page < 1:
+        if self._loaded_page < 1 or view is not self._view:
             return
 
         self._scrollval = scrollval
+        if self._shown_filename != self._loaded_filename:
+            # the file is being loaded
+            return
+        pageno = self._get_pageno_for_scrollfactor(self._get_scrollfactor())
+        if pageno is not None:
+            self._on_page_changed(self._loaded_page, pageno, coalesce=True)
+
+    def _get_pageno_for_scrollfactor(self, scrollfactor):
+        '''
+        Returns the page at the position (fraction) in the loaded file,
+        or None if the file is not paginated
+        '''
+        base_pageno = self._paginator.get_base_pageno_for_file(
+            self._loaded_filename)
+        if base_pageno is None:
+            return None
+        pages = self._paginator.get_pagecount_for_file(self._loaded_filename)
+        return int(base_pageno) + min(pages - 1,
+                                      int(scrollfactor * pages + 1e-6))
+
+    def _get_scrollfactor(self):
+        '''
+        Returns the position (fraction) of the view in the loaded file
+        '''
         scroll_upper = self._page_height
         scroll_page_size = self._view.get_allocated_height()
 
-        if scrollval > 0:
+        if self._scrollval > 0:
             try:
-                scrollfactor = scrollval / (scroll_upper - scroll_page_size)
+                return self._scrollval / (scroll_upper - scroll_page_size)
             except ZeroDivisionError:
-                scrollfactor = 0
-        else:
-            scrollfactor = 0
-
-        if not self._loaded_page == self._pagecount and \
-            not self._paginator.get_file_for_pageno(self._loaded_page) != \
-                self._paginator.get_file_for_pageno(self._loaded_page + 1):
-
-            scrollfactor_next = \
-                self._paginator.get_scrollfactor_pos_for_pageno(
-                    self._loaded_page + 1)
-            if scrollfactor >= scrollfactor_next:
-                self._on_page_changed(self._loaded_page, self._loaded_page + 1)
-                return
-
-        if self._loaded_page > 1 and \
-            not self._paginator.get_file_for_pageno(self._loaded_page) != \
-                self._paginator.get_file_for_pageno(self._loaded_page - 1):
-
-            scrollfactor_cur = \
-                self._paginator.get_scrollfactor_pos_for_pageno(
-                    self._loaded_page)
-            if scrollfactor <= scrollfactor_cur:
-                self._on_page_changed(self._loaded_page, self._loaded_page - 1)
-                return
+                return 0
+        return 0
 
     def _view_scrolled_top_cb(self, view):
-        if self._loaded_page > 1:
+        if self._loaded_page > 1 and view is self._view:
             self.__scroll_to_end = True
             self._load_prev_page()
 
     def _view_scrolled_bottom_cb(self, view):
-        if self._loaded_page < self._pagecount:
+        if self._loaded_page < self._pagecount and view is self._view:
             self._load_next_page()
 
     def _view_selection_changed_cb(self, view, has_selection):
+        if view is not self._view:
+            return
         self._has_selection = has_selection
         self.emit('selection-changed')
 
@@ -429,60 +489,87 @@ class _View(Gtk.HBox):
         if load_event != WebKit2.LoadEvent.FINISHED:
             return True
 
-        filename = self._view.props.uri.replace('file://', '')
-        if os.path.exists(filename.replace('xhtml', 'xml')):
-            # Hack for making javascript work
-            filename = filename.replace('xhtml', 'xml')
+        if v is self._standby_view:
+            filename = self._epub.get_entry(v.props.uri)
+            if filename is not None and filename == self._standby_filename:
+                v.get_page_height(self._standby_page_height_cb, filename)
+            return False
 
-        filename = filename.split('#')[0]  # Get rid of anchors
+        # Get the file in the epub, without anchors
+        filename = self._epub.get_entry(self._view.props.uri)
 
         if self._loaded_page < 1 or filename is None:
             return False
 
         self._loaded_filename = filename
 
+        # the page is measured by scripts, without waiting for them
+        self._view.get_page_height(self._page_height_cb, filename)
+
+    def _add_padding(self, view, filename, pageheight):
+        # the file is padded to fill the last page, returns the
+        # pagination used, to know if the padding need be updated
         remfactor = self._paginator.get_remfactor_for_file(filename)
         pages = self._paginator.get_pagecount_for_file(filename)
         extra = int(math.ceil(
-            remfactor * self._view.get_page_height() / (pages - remfactor)))
+            remfactor * pageheight / (pages - remfactor)))
         if extra > 0:
-            self._view.add_bottom_padding(extra)
-        self._page_height = self._view.get_page_height()
-
-        if self.__in_search:
-            self.__in_search = False
-            find = self._view.get_find_controller()
-            find.search(self._findjob.get_search_text(),
-                        self._findjob.get_flags(self.__search_fwd),
-                        GObject.G_MAXUINT)
-        else:
-            self._scroll_page()
+            view.add_bottom_padding(extra)
+        return pages, remfactor
+
+    def _page_height_cb(self, view, pageheight, filename):
+        if filename != self._loaded_filename or view is not self._view:
+            # other file was loaded
+            return
+
+        self._loaded_pagination = self._add_padding(view, filename,
+                                                    pageheight)
+        self._loaded_base_height = pageheight
+        self._view.get_page_height(self._padded_page_height_cb, filename)
+
+    def _padded_page_height_cb(self, view, pageheight, filename):
+        if filename != self._loaded_filename or view is not self._view:
+            return
+        self._page_height = pageheight
+        self._shown_filename = filename
+        self.emit('file-loaded', filename)
+
+        self._scroll_page()
+        if self._pending_match is not None and \
+                self._pending_match[0] == filename:
+            self._select_match()
 
         # process_file = True
         if self._internal_link is not None:
-            self._view.go_to_link(self._internal_link)
-            vertical_pos = \
-                self._view.get_vertical_position_element(self._internal_link)
-            # set the page number based in the vertical position
-            initial_page = self._paginator.get_base_pageno_for_file(filename)
-            self._loaded_page = initial_page + int(
-                vertical_pos / self._paginator.get_single_page_height())
-
-            # There are epub files, created with Calibre,
-            # where the link in the index points to the end of the previos
-            # file to the needed chapter.
-            # if the link is at the bottom of the page, we open the next file
-            one_page_height = self._paginator.get_single_page_height()
+            internal_link = self._internal_link
             self._internal_link = None
-            if vertical_pos > self._page_height - one_page_height:
-                logging.error('bottom page link, go to next file')
-                next_file = self._paginator.get_next_filename(filename)
-                if next_file is not None:
-                    logging.error('load next file %s', next_file)
-                    self.__in_search = False
-                    self.__scroll_to_end = False
-                    # process_file = False
-                    GObject.idle_add(self._load_file, next_file)
+            self._view.go_to_link(internal_link)
+            self._view.get_vertical_position_element(
+                internal_link, self._link_position_cb, filename)
+
+        self._prefetch_file()
+
+    def _link_position_cb(self, view, vertical_pos, filename):
+        if filename != self._loaded_filename or view is not self._view:
+            return
+        # set the page number based in the vertical position
+        initial_page = self._paginator.get_base_pageno_for_file(filename)
+        self._loaded_page = initial_page + int(
+            vertical_pos / self._paginator.get_single_page_height())
+
+        # There are epub files, created with Calibre,
+        # where the link in the index points to the end of the previos
+        # file to the needed chapter.
+        # if the link is at the bottom of the page, we open the next file
+        one_page_height = self._paginator.get_single_page_height()
+        if vertical_pos > self._page_height - one_page_height:
+            logging.error('bottom page link, go to next file')
+            next_file = self._paginator.get_next_filename(filename)
+            if next_file is not None:
+                logging.error('load next file %s', next_file)
+                self.__scroll_to_end = False
+                # process_file = False
+                GObject.idle_add(self._load_file, next_file)
 
 #        if process_file:
 #            # prepare text to speech
@@ -493,29 +580,75 @@ class _View(Gtk.HBox):
 #            self._all_text = ''.join([tag for tag in tags])
 #            self._prepare_text_to_speech(self._all_text)
 
+    def _standby_page_height_cb(self, view, pageheight, filename):
+        if filename != self._standby_filename or \
+                view is not self._standby_view:
+            return
+        self._standby_pagination = self._add_padding(view, filename,
+                                                     pageheight)
+        self._standby_base_height = pageheight
+        view.get_page_height(self._standby_padded_page_height_cb, filename)
+
+    def _standby_padded_page_height_cb(self, view, pageheight, filename):
+        if filename != self._standby_filename or \
+                view is not self._standby_view:
+            return
+        self._standby_page_height = pageheight
+
+    def _prefetch_file(self):
+        if self.__prefetch_backward:
+            filename = self._paginator.get_prev_filename(
+                self._loaded_filename)
+        else:
+            filename = self._paginator.get_next_filename(
+                self._loaded_filename)
+        size = (self._view.get_allocated_width(),
+                self._view.get_allocated_height())
+        if filename is None or (filename == self._standby_filename and
+                                size == self._standby_size):
+            return
+
+        self._standby_filename = filename
+        self._standby_size = size
+        self._standby_page_height = None
+        self._standby_view.stop_loading()
+        self._standby_view.set_size_request(*size)
+        self._standby_view.load_uri(self._epub.get_uri(filename))
+
+    def _can_swap_views(self, filename):
+        # the file in the hidden view can be shown if it was measured
+        # with the same size and pagination than the visible view
+        return filename == self._standby_filename and \
+            self._standby_page_height is not None and \
+            self._standby_size == (self._view.get_allocated_width(),
+                                   self._view.get_allocated_height()) and \
+            self._standby_pagination == (
+                self._paginator.get_pagecount_for_file(filename),
+                self._paginator.get_remfactor_for_file(filename))
+
+    def _swap_views(self):
+        view = self._standby_view
+        self._standby_view = self._view
+        self._view = view
+        self._page_height = self._standby_page_height
+        self._loaded_pagination = self._standby_pagination
+        self._loaded_base_height = self._standby_base_height
+        self._standby_filename = None
+        self._standby_page_height = None
+
+        self._eventbox.remove(self._standby_view)
+        self._standby_window.remove(self._view)
+        # the size of the hidden view was fixed to paginate the file
+        self._view.set_size_request(-1, -1)
+        self._eventbox.add(self._view)
+        self._standby_window.add(self._standby_view)
+        self._view.show()
+        self._view.grab_focus()
+
     def _prepare_text_to_speech(self, page_text):
-        i = 0
-        j = 0
-        word_begin = 0
-        word_end = 0
-        ignore_chars = [' ', '\n', '\r', '_', '[', '{', ']', '}', '|',
-                        '<', '>', '*', '+', '/', '\\']
-        ignore_set = set(ignore_chars)
-        self.word_tuples = []
-        len_page_text = len(page_text)
-        while i < len_page_text:
-            if page_text[i] not in ignore_set:
-                word_begin = i
-                j = i
-                while j < len_page_text and page_text[j] not in ignore_set:
-                    j = j + 1
-                    word_end = j
-                    i = j
-                word_tuple = (word_begin, word_end,
-                              page_text[word_begin: word_end])
-                if word_tuple[2] != '\r':
-                    self.word_tuples.append(word_tuple)
-            i = i + 1
+        # the words are split only when the text to speech need them
+        self._speech_text = page_text
+        self._speech_words = None
 
     def _scroll_page(self):
         v_upper = self._page_height
@@ -531,27 +664,33 @@ class _View(Gtk.HBox):
         self._view.scroll_to(scrollval)
 
     def _paginate(self):
-        filelist = []
-        for i in self._epub._navmap.get_flattoc():
-            filelist.append(os.path.join(self._epub._tempdir, i))
         # init files info
-        self._filelist = filelist
-        self._paginator = _Paginator(filelist)
+        self._filelist = self._epub.get_flattoc()
+        self._paginator = _Paginator(self._epub,
+                                     self._pagination_cache_path,
+                                     self._pagination_cache_key)
         self._paginator.connect('paginated', self._paginated_cb)
+        self._paginator.connect('updated', self._paginator_updated_cb)
+
+        # the book can be read while the paginator measures the files,
+        # with the pages of the files not measured estimated
+        self._ready = True
+        self._update_pagecount()
+        if self._pending_page is not None:
+            pageno = min(self._pending_page, self._pagecount)
+            self._pending_page = None
+            self._load_page(pageno)
 
     def get_filelist(self):
         return self._filelist
 
-    def get_tempdir(self):
-        return self._epub._tempdir
-
     def _load_next_page(self):
         self._load_page(self._loaded_page + 1)
 
     def _load_prev_page(self):
         self._load_page(self._loaded_page - 1)
 
-    def _on_page_changed(self, oldpage, pageno):
+    def _on_page_changed(self, oldpage, pageno, coalesce=False):
         if oldpage == pageno:
             return
         self.__page_changed = True
@@ -559,9 +698,31 @@ class _View(Gtk.HBox):
         self._scrollbar.handler_block(self._scrollbar_change_value_cb_id)
         self._scrollbar.set_value(pageno)
         self._scrollbar.handler_unblock(self._scrollbar_change_value_cb_id)
+
+        # while scrolling, the page changes are emitted together
+        # after PAGE_CHANGED_INTERVAL
+        if coalesce:
+            if self._page_changed_id is None:
+                self._page_changed_from = oldpage
+                self._page_changed_id = GObject.timeout_add(
+                    PAGE_CHANGED_INTERVAL, self.__emit_page_changed)
+            return
+        if self._page_changed_id is not None:
+            GObject.source_remove(self._page_changed_id)
+            self._page_changed_id = None
+            oldpage = self._page_changed_from
+            if oldpage == pageno:
+                return
         # the indexes in read activity are zero based
         self.emit('page-changed', (oldpage - 1), (pageno - 1))
 
+    def __emit_page_changed(self):
+        self._page_changed_id = None
+        if self._page_changed_from != self._loaded_page:
+            self.emit('page-changed', (self._page_changed_from - 1),
+                      (self._loaded_page - 1))
+        return False
+
     def _load_page(self, pageno):
         if pageno > self._pagecount or pageno < 1:
             # TODO: Cause an exception
@@ -572,11 +733,8 @@ class _View(Gtk.HBox):
         oldpage = self._loaded_page
 
         filename = self._paginator.get_file_for_pageno(pageno)
-        filename = filename.replace('file://', '')
 
         if filename != self._loaded_filename:
-            self._loaded_filename = filename
-
             """
             TODO: disabled because javascript can't be executed
             with the velocity needed
@@ -589,14 +747,22 @@ class _View(Gtk.HBox):
             now text highlight is implemented and the epub file is saved
             """
 
+            self.__prefetch_backward = pageno < oldpage
             self._view.stop_loading()
-            if filename.endswith('xml'):
-                dest = filename.replace('xml', 'xhtml')
-                if not os.path.exists(dest):
-                    os.symlink(filename, dest)
-                self._view.load_uri('file://' + dest)
+            self._loaded_filename = filename
+            if self._can_swap_views(filename):
+                # the file was loaded in the hidden view
+                self._swap_views()
+                self._shown_filename = filename
+                self._loaded_page = pageno
+                self._scroll_page()
+                self.emit('file-loaded', filename)
+                self._prefetch_file()
             else:
-                self._view.load_uri('file://' + filename)
+                self._shown_filename = None
+                self._loading_scrollfactor = \
+                    self._paginator.get_scrollfactor_pos_for_pageno(pageno)
+                self._view.load_uri(self._epub.get_uri(filename))
         else:
             self._loaded_page = pageno
             self._scroll_page()
@@ -620,7 +786,10 @@ class _View(Gtk.HBox):
 
         for filepath in self._filelist:
             if filepath.endswith(path):
-                self._view.load_uri('file://' + filepath)
+                self._loaded_filename = filepath
+                self._shown_filename = None
+                self._loading_scrollfactor = 0
+                self._view.load_uri(self._epub.get_uri(filepath))
                 oldpage = self._loaded_page
                 self._loaded_page = \
                     self._paginator.get_base_pageno_for_file(filepath)
@@ -652,14 +821,54 @@ class _View(Gtk.HBox):
         else:
             return True
 
-    def _paginated_cb(self, object):
-        self._ready = True
-
+    def _update_pagecount(self):
         self._pagecount = self._paginator.get_total_pagecount()
         self._scrollbar.set_range(1.0, self._pagecount)
         self._scrollbar.set_increments(1.0, 1.0)
+        self.emit('pagecount-changed', self._pagecount)
+
+        if self._loaded_filename is None or self._loaded_page < 1:
+            return
+        filename = self._loaded_filename
+        if filename == self._shown_filename and \
+                self._loaded_pagination != (
+                    self._paginator.get_pagecount_for_file(filename),
+                    self._paginator.get_remfactor_for_file(filename)):
+            # the pages of the loaded file were measured, the padding
+            # and the height are updated like in the hidden view
+            self._loaded_pagination = self._add_padding(
+                self._view, filename, self._loaded_base_height)
+            self._view.get_page_height(self._repadded_page_height_cb,
+                                       filename)
+        # the number of the loaded page changes if the pages of
+        # the files before, or of the loaded file, were measured
+        if self._view.is_loading():
+            scrollfactor = self._loading_scrollfactor
+        else:
+            scrollfactor = self._get_scrollfactor()
+        pageno = self._get_pageno_for_scrollfactor(scrollfactor)
+        if pageno is not None:
+            self._on_page_changed(self._loaded_page, pageno)
+
+    def _repadded_page_height_cb(self, view, pageheight, filename):
+        if filename != self._shown_filename or view is not self._view:
+            return
+        self._page_height = pageheight
+        pageno = self._get_pageno_for_scrollfactor(self._get_scrollfactor())
+        if pageno is not None:
+            self._on_page_changed(self._loaded_page, pageno)
+
+    def _paginator_updated_cb(self, paginator):
+        self._update_pagecount()
+
+    def _paginated_cb(self, object):
+        self._update_pagecount()
         self._view.grab_focus()
         self._view.grab_default()
 
     def _destroy_cb(self, widget):
+        if self._page_changed_id is not None:
+            GObject.source_remove(self._page_changed_id)
+            self._page_changed_id = None
+        self._standby_window.destroy()
         self._epub.close()
@@ -27,16 +27,51 @@ from gi.repository import Gtk
 from gi.repository import Gdk
 from gi.repository import WebKit2
 from . import widgets
+from . import bodytext
+from findjob import FindJob
+from findjob import SearchThread
+from findjob import find_all
+from readcache import load_book_data
+from readcache import save_book_data
+import array
+import logging
+import json
 import math
-import os.path
+import os
+import select
+import subprocess
+import sys
 import xml.etree.ElementTree as etree
-import html.entities as html_entities
 
-import threading
+from bisect import bisect_right
 
 PAGE_WIDTH = 135
 PAGE_HEIGHT = 216
 
+FONT_FAMILY = 'DejaVu LGC Serif'
+SANS_SERIF_FONT_FAMILY = 'DejaVu LGC Sans'
+MONOSPACE_FONT_FAMILY = 'DejaVu LGC Sans Mono'
+FONT_SIZE = 16
+MONOSPACE_FONT_SIZE = 13
+ZOOM_LEVEL = 1.0
+
+# change it if the stored pagination is not compatible anymore
+PAGINATION_CACHE_VERSION = 2
+
+# the files are paginated at the same time in several hidden web views,
+# one by cpu core, but every web view use a web process, then the number
+# of web views is limited by the memory too
+MAX_PAGINATOR_VIEWS = 4
+PAGINATOR_VIEW_MEMORY = 256 * 1024 * 1024
+
+# used to estimate the pages of the files not paginated yet,
+# until some files are measured
+ESTIMATED_PAGE_BYTES = 3000
+
+# seconds waiting for the search processes before checking
+# if the search was cancelled
+SEARCH_PROCESS_TIMEOUT = 0.1
+
 
 def _pixel_to_mm(pixel, dpi):
     inches = pixel / dpi
@@ -48,73 +83,194 @@ def _mm_to_pixel(mm, dpi):
     return int(inches * dpi)
 
 
-class SearchThread(threading.Thread):
-
-    def __init__(self, obj):
-        threading.Thread.__init__(self)
-        self.obj = obj
-        self.stopthread = threading.Event()
-
-    def _start_search(self):
-        for entry in self.obj.flattoc:
-            if self.stopthread.isSet():
-                break
-            filepath = os.path.join(self.obj._document.get_basedir(), entry)
-            f = open(filepath)
-            if self._searchfile(f):
-                self.obj._matchfilelist.append(entry)
-            f.close()
-
-        self.obj._finished = True
-        GObject.idle_add(self.obj.emit, 'updated')
-
-        return False
-
-    def _searchfile(self, fileobj):
-        parser = etree.XMLParser(html=1)
-        for name, codepoint in html_entities.name2codepoint.items():
-            parser.entity[name] = chr(codepoint)
-        tree = etree.parse(fileobj, parser=parser)
-        root = tree.getroot()
+def get_paginator_pool_size():
+    '''
+    Returns the number of web views used to paginate a book,
+    based on the cores and the memory of the computer
+    '''
+    pool_size = min(MAX_PAGINATOR_VIEWS, os.cpu_count() or 1)
+    try:
+        memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return pool_size
+    return max(1, min(pool_size, memory // PAGINATOR_VIEW_MEMORY))
+
+
+class _SearchProcess(object):
+    '''
+    Process reading the text of some files of the book. The processes
+    run the bodytext module as a script, that only uses the standard
+    library: forking the activity from a thread could copy locks taken
+    by other threads, and multiprocessing with spawn or forkserver runs
+    the main script of the activity again.
+    '''
+
+    def __init__(self, file_path, entries):
+        self._process = subprocess.Popen(
+            [sys.executable, bodytext.__file__, file_path],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self._buffer = bytearray()
+        self._failed = False
+        self._process.stdin.write(json.dumps(entries).encode('utf-8'))
+        self._process.stdin.close()
+
+    def read_result(self, stopthread):
+        '''
+        Returns a (text, error) tuple with the result of the next file,
+        or None if the process failed or the search was cancelled
+        '''
+        fd = self._process.stdout.fileno()
+        end = self._buffer.find(b'\n')
+        while end < 0:
+            if self._failed or stopthread.is_set():
+                return None
+            ready = select.select([fd], [], [], SEARCH_PROCESS_TIMEOUT)[0]
+            if not ready:
+                continue
+            data = os.read(fd, 65536)
+            if not data:
+                self._failed = True
+                return None
+            start = len(self._buffer)
+            self._buffer.extend(data)
+            end = self._buffer.find(b'\n', start)
+        line = bytes(self._buffer[:end])
+        del self._buffer[:end + 1]
+        try:
+            result = json.loads(line.decode('utf-8'))
+        except ValueError:
+            self._failed = True
+            return None
+        return result.get('text'), result.get('error')
 
-        body = None
-        for child in root:
-            if child.tag.endswith('body'):
-                body = child
+    def stop(self):
+        self._process.kill()
+        self._process.wait()
+        self._process.stdout.close()
 
-        if body is None:
-            return False
 
-        for child in body.iter():
-            if child.text is not None:
-                if child.text.lower().find(self.obj._text.lower()) > -1:
-                    return True
+class _SearchThread(SearchThread):
 
-        return False
+    def _iter_index_positions(self, text, pages):
+        # the pages in the index are the positions in the flat toc
+        for n, file_text in pages:
+            self.obj._text_lengths[n] = len(file_text)
+            yield n, find_all(file_text.lower(), text)
 
-    def run(self):
-        self._start_search()
+    def _get_positions(self, n, entry, text):
+        try:
+            file_text = self.obj._document.get_text(entry)
+        except (IOError, KeyError, etree.ParseError) as e:
+            logging.error('Can not search in %s: %s', entry, e)
+            return array.array('i')
+        self.obj._text_lengths[n] = len(file_text)
+        return find_all(file_text.lower(), text)
+
+    def _iter_positions(self, text):
+        # the files not read yet are read and parsed in other processes,
+        # the texts already read are searched in this thread. The texts
+        # are kept, and the full text index is used after indexing the
+        # book, then the processes are used only in the first search.
+        document = self.obj._document
+        # the files searched by the processes are selected before
+        # starting them, the texts can be read by other thread
+        entries = [entry for entry in self.obj.flattoc
+                   if not document.has_text(entry)]
+        pooled_entries = set(entries)
+        file_path = document.get_file_path()
+        n_processes = min(os.cpu_count() or 1, len(entries))
+        processes = []
+        if file_path is not None and n_processes > 1:
+            try:
+                for i in range(n_processes):
+                    # every process reads one of every n_processes files
+                    processes.append(_SearchProcess(
+                        file_path, entries[i::n_processes]))
+            except OSError as e:
+                logging.error('Can not start the search processes: %s', e)
+                for process in processes:
+                    process.stop()
+                processes = []
 
-    def stop(self):
-        self.stopthread.set()
+        try:
+            n_pooled = 0
+            for n, entry in enumerate(self.obj.flattoc):
+                if processes and entry in pooled_entries:
+                    process = processes[n_pooled % len(processes)]
+                    n_pooled += 1
+                    result = process.read_result(self.stopthread)
+                    if self.stopthread.is_set():
+                        return
+                    if result is not None:
+                        file_text, error = result
+                        if error is not None:
+                            logging.error('Can not search in %s: %s',
+                                          entry, error)
+                            yield n, array.array('i')
+                            continue
+                        if not document.has_text(entry):
+                            document.set_text(entry, file_text)
+                        self.obj._text_lengths[n] = len(file_text)
+                        yield n, find_all(file_text.lower(), text)
+                        continue
+                # the files already read, and the files of a process
+                # that failed, are read in this thread
+                yield n, self._get_positions(n, entry, text)
+        finally:
+            # the processes are stopped if the search was cancelled
+            for process in processes:
+                process.stop()
 
 
 class _JobPaginator(GObject.GObject):
 
     __gsignals__ = {
         'paginated': (GObject.SignalFlags.RUN_FIRST, GObject.TYPE_NONE, ([])),
+        'updated': (GObject.SignalFlags.RUN_FIRST, GObject.TYPE_NONE, ([])),
     }
 
-    def __init__(self, filelist):
+    def __init__(self, document, cache_path=None, cache_key=None,
+                 pool_size=None):
+        '''
+        cache_path: file where the pagination is stored, to not paginate
+        the book again when opened with the same settings
+        cache_key: dict with the info of the book to verify
+        the stored pagination
+        pool_size: number of web views used to paginate the files,
+        by default get_paginator_pool_size()
+
+        While the files are measured, the pages of the other files are
+        estimated by their size, then the book can be read at once.
+        The signal 'updated' is emitted every time a file is measured
+        and 'paginated' when all the files are measured.
+        '''
         GObject.GObject.__init__(self)
 
-        self._filelist = filelist
-        self._filedict = {}
-        self._pagemap = {}
+        self._document = document
+        self._filelist = document.get_flattoc()
+        # the pages are not stored, only the first page of every file,
+        # and the pages (fraction) of the file. The file of a page is
+        # found with a binary search in the first pages.
+        self._file_first_pages = array.array('i')
+        self._file_pages = array.array('d')
+        # index in the file list of every file name
+        self._file_indexes = {}
+        for index, filename in enumerate(self._filelist):
+            self._file_indexes.setdefault(filename, index)
 
         self._bookheight = 0
+        # files measured
         self._count = 0
         self._pagecount = 0
+        # next file to load in a web view
+        self._next_file = 0
+        # file loaded in every web view
+        self._view_files = {}
+        # heights of the files measured, None if not measured yet
+        self._heights = [None] * len(self._filelist)
+        self._measured_bytes = 0
+        self._measured_pages = 0
+        self._temp_windows = []
 
         # TODO
         """
@@ -128,33 +284,74 @@ class _JobPaginator(GObject.GObject):
         self._screen.set_font_options(options)
         """
 
-        self._temp_win = Gtk.Window()
-        self._temp_view = widgets._WebView()
+        self._dpi = Gdk.Screen.get_default().get_resolution()
+        self._single_page_height = _mm_to_pixel(PAGE_HEIGHT, self._dpi)
 
-        settings = self._temp_view.get_settings()
-        settings.props.default_font_family = 'DejaVu LGC Serif'
-        settings.props.sans_serif_font_family = 'DejaVu LGC Sans'
-        settings.props.serif_font_family = 'DejaVu LGC Serif'
-        settings.props.monospace_font_family = 'DejaVu LGC Sans Mono'
+        self._cache_path = cache_path
+        self._cache_key = {'version': PAGINATION_CACHE_VERSION,
+                           'dpi': self._dpi,
+                           'page_width': PAGE_WIDTH,
+                           'page_height': PAGE_HEIGHT,
+                           'font_family': FONT_FAMILY,
+                           'sans_serif_font_family': SANS_SERIF_FONT_FAMILY,
+                           'monospace_font_family': MONOSPACE_FONT_FAMILY,
+                           'font_size': FONT_SIZE,
+                           'monospace_font_size': MONOSPACE_FONT_SIZE,
+                           'zoom': ZOOM_LEVEL,
+                           'files': self._filelist}
+        if cache_key is not None:
+            self._cache_key.update(cache_key)
+        if self._load_cache():
+            logging.debug('using stored pagination %s', cache_path)
+            GObject.idle_add(self.emit, 'paginated')
+            return
+
+        if not self._filelist:
+            GObject.idle_add(self.emit, 'paginated')
+            return
+
+        self._update_pagemap()
+
+        if pool_size is None:
+            pool_size = get_paginator_pool_size()
+        for i in range(min(pool_size, len(self._filelist))):
+            self._load_next_file(self._create_view())
+
+    def _create_view(self):
+        temp_win = Gtk.Window()
+        temp_view = widgets._WebView()
+
+        settings = temp_view.get_settings()
+        settings.props.default_font_family = FONT_FAMILY
+        settings.props.sans_serif_font_family = SANS_SERIF_FONT_FAMILY
+        settings.props.serif_font_family = FONT_FAMILY
+        settings.props.monospace_font_family = MONOSPACE_FONT_FAMILY
         # FIXME: This does not seem to work
         # settings.props.auto_shrink_images = False
         settings.props.enable_plugins = False
-        settings.props.default_font_size = 16
-        settings.props.default_monospace_font_size = 13
+        settings.props.default_font_size = FONT_SIZE
+        settings.props.default_monospace_font_size = MONOSPACE_FONT_SIZE
         settings.props.default_charset = 'utf-8'
+        temp_view.set_zoom_level(ZOOM_LEVEL)
 
-        self._dpi = Gdk.Screen.get_default().get_resolution()
-        self._single_page_height = _mm_to_pixel(PAGE_HEIGHT, self._dpi)
-        self._temp_view.set_size_request(
+        temp_view.set_size_request(
             _mm_to_pixel(PAGE_WIDTH, self._dpi), self._single_page_height)
 
-        self._temp_win.add(self._temp_view)
-        self._temp_view.connect('load-changed', self._page_load_changed_cb)
+        temp_win.add(temp_view)
+        temp_view.connect('load-changed', self._page_load_changed_cb)
 
-        self._temp_win.show_all()
-        self._temp_win.unmap()
+        temp_win.show_all()
+        temp_win.unmap()
+        self._temp_windows.append(temp_win)
+        return temp_view
 
-        self._temp_view.load_uri('file://' + self._filelist[self._count])
+    def _load_next_file(self, view):
+        if self._next_file >= len(self._filelist):
+            return
+        self._view_files[view] = self._next_file
+        view.load_uri(
+            self._document.get_uri(self._filelist[self._next_file]))
+        self._next_file += 1
 
     def get_single_page_height(self):
         """
@@ -162,94 +359,153 @@ class _JobPaginator(GObject.GObject):
         """
         return self._single_page_height
 
+    def _load_cache(self):
+        if self._cache_path is None:
+            return False
+        data = load_book_data(self._cache_path, self._cache_key)
+        if data is None:
+            return False
+        self._heights = data['heights']
+        self._count = len(self._filelist)
+        self._update_pagemap()
+        return True
+
+    def _save_cache(self):
+        if self._cache_path is None:
+            return
+        save_book_data(self._cache_path, self._cache_key,
+                       {'heights': self._heights})
+
     def get_next_filename(self, actual_filename):
-        for n in range(len(self._filelist)):
-            filename = self._filelist[n]
-            if filename == actual_filename:
-                if n < len(self._filelist):
-                    return self._filelist[n + 1]
+        index = self._file_indexes.get(actual_filename)
+        if index is not None and index + 1 < len(self._filelist):
+            return self._filelist[index + 1]
+        return None
+
+    def get_prev_filename(self, actual_filename):
+        index = self._file_indexes.get(actual_filename)
+        if index is not None and index > 0:
+            return self._filelist[index - 1]
         return None
 
     def _page_load_changed_cb(self, v, load_event):
         if load_event != WebKit2.LoadEvent.FINISHED:
             return True
 
-        pageheight = v.get_page_height()
+        index = self._view_files.pop(v, None)
+        if index is not None:
+            v.get_page_height(self._page_height_cb, index)
 
-        if pageheight <= self._single_page_height:
-            pages = 1
-        else:
-            pages = pageheight / float(self._single_page_height)
-        for i in range(1, int(math.ceil(pages) + 1)):
-            if pages - i < 0:
-                pagelen = (pages - math.floor(pages)) / pages
-            else:
-                pagelen = 1 / pages
-            self._pagemap[float(self._pagecount + i)] = \
-                (v.get_uri(), (i - 1) / math.ceil(pages), pagelen)
+    def _page_height_cb(self, v, pageheight, index):
+        self._heights[index] = pageheight
+        self._count += 1
+        self._measured_bytes += self._document.get_file_size(
+            self._filelist[index])
+        self._measured_pages += \
+            max(1.0, pageheight / float(self._single_page_height))
+        self._load_next_file(v)
 
-        self._pagecount += int(math.ceil(pages))
-        self._filedict[v.get_uri().replace('file://', '')] = \
-            (math.ceil(pages), math.ceil(pages) - pages)
-        self._bookheight += pageheight
+        # the estimated pages of the file are replaced by the measured
+        self._update_pagemap()
 
-        if self._count + 1 >= len(self._filelist):
+        if self._count >= len(self._filelist):
             # TODO
             # self._screen.set_font_options(self._old_fontoptions)
+            self._save_cache()
             self.emit('paginated')
             GObject.idle_add(self._cleanup)
-
         else:
-            self._count += 1
-            self._temp_view.load_uri('file://' + self._filelist[self._count])
+            self.emit('updated')
+
+    def _estimate_height(self, filename):
+        '''
+        Returns the height of a file not measured yet, estimated with
+        the bytes by page of the files already measured
+        '''
+        page_bytes = ESTIMATED_PAGE_BYTES
+        if self._measured_pages > 0 and self._measured_bytes > 0:
+            page_bytes = self._measured_bytes / self._measured_pages
+        pages = max(1, int(round(
+            self._document.get_file_size(filename) / page_bytes)))
+        return pages * self._single_page_height
+
+    def _update_pagemap(self):
+        self._file_first_pages = array.array('i')
+        self._file_pages = array.array('d')
+        self._pagecount = 0
+        self._bookheight = 0
+        for filename, pageheight in zip(self._filelist, self._heights):
+            if pageheight is None:
+                pageheight = self._estimate_height(filename)
+            if pageheight <= self._single_page_height:
+                pages = 1
+            else:
+                pages = pageheight / float(self._single_page_height)
+            self._file_first_pages.append(self._pagecount + 1)
+            self._file_pages.append(pages)
+            self._pagecount += int(math.ceil(pages))
+            self._bookheight += pageheight
+
+    def _get_file_index_for_pageno(self, pageno):
+        return bisect_right(self._file_first_pages, pageno) - 1
 
     def _cleanup(self):
-        self._temp_win.destroy()
+        for temp_win in self._temp_windows:
+            temp_win.destroy()
+        self._temp_windows = []
 
     def get_file_for_pageno(self, pageno):
         '''
         Returns the file in which pageno occurs
         '''
-        return self._pagemap[pageno][0]
+        return self._filelist[self._get_file_index_for_pageno(pageno)]
 
     def get_scrollfactor_pos_for_pageno(self, pageno):
         '''
         Returns the position scrollfactor (fraction) for pageno
         '''
-        return self._pagemap[pageno][1]
+        index = self._get_file_index_for_pageno(pageno)
+        return (pageno - self._file_first_pages[index]) / \
+            math.ceil(self._file_pages[index])
 
     def get_scrollfactor_len_for_pageno(self, pageno):
         '''
         Returns the length scrollfactor (fraction) for pageno
         '''
-        return self._pagemap[pageno][2]
+        index = self._get_file_index_for_pageno(pageno)
+        pages = self._file_pages[index]
+        if pageno - self._file_first_pages[index] + 1 > pages:
+            # the last page is not complete
+            return (pages - math.floor(pages)) / pages
+        return 1 / pages
 
     def get_pagecount_for_file(self, filename):
         '''
         Returns the number of pages in file
         '''
-        return self._filedict[filename][0]
+        return math.ceil(self._file_pages[self._file_indexes[filename]])
 
     def get_base_pageno_for_file(self, filename):
         '''
         Returns the pageno which begins in filename
         '''
-        for key in list(self._pagemap.keys()):
-            if self._pagemap[key][0].replace('file://', '') == filename:
-                return key
-
-        return None
+        index = self._file_indexes.get(filename)
+        if index is None or index >= len(self._file_first_pages):
+            return None
+        return self._file_first_pages[index]
 
     def get_remfactor_for_file(self, filename):
         '''
         Returns the remainder
         factor (1 - fraction length of last page in file)
         '''
-        return self._filedict[filename][1]
+        pages = self._file_pages[self._file_indexes[filename]]
+        return math.ceil(pages) - pages
 
     def get_total_pagecount(self):
         '''
-        Returns the total pagecount for the Epub file
+        Returns the total pagecount for the Epub file,
+        estimated until the book is paginated
         '''
         return self._pagecount
 
@@ -260,85 +516,44 @@ class _JobPaginator(GObject.GObject):
         return self._bookheight
 
 
-class _JobFind(GObject.GObject):
-    __gsignals__ = {
-        'updated': (GObject.SignalFlags.RUN_FIRST, GObject.TYPE_NONE, ([])),
-    }
+class _JobFind(FindJob):
 
     def __init__(self, document, start_page, n_pages, text,
-                 case_sensitive=False):
+                 case_sensitive=False, fulltext_index=None):
         """
         Only case_sensitive=False is implemented
+        fulltext_index: if indexed, is used to find the files
+        with matches instead of reading all the files
         """
-        GObject.GObject.__init__(self)
-
-        self._finished = False
+        FindJob.__init__(self, start_page, n_pages, text, case_sensitive)
         self._document = document
-        self._start_page = start_page
-        self._n_pages = n_pages
-        self._text = text
-        self._case_sensitive = case_sensitive
         self.flattoc = self._document.get_flattoc()
-        self._matchfilelist = []
-        self._current_file_index = 0
-        self.threads = []
-
-        s_thread = SearchThread(self)
-        self.threads.append(s_thread)
-        s_thread.start()
-
-    def cancel(self):
-        '''
-        Cancels the search job
-        '''
-        for s_thread in self.threads:
-            s_thread.stop()
-
-    def is_finished(self):
-        '''
-        Returns True if the entire search job has been finished
-        '''
-        return self._finished
-
-    def get_next_file(self):
-        '''
-        Returns the next file which has the search pattern
-        '''
-        self._current_file_index += 1
-        try:
-            path = self._matchfilelist[self._current_file_index]
-        except IndexError:
-            self._current_file_index = 0
-            path = self._matchfilelist[self._current_file_index]
-
-        return path
-
-    def get_prev_file(self):
-        '''
-        Returns the previous file which has the search pattern
-        '''
-        self._current_file_index -= 1
-        try:
-            path = self._matchfilelist[self._current_file_index]
-        except IndexError:
-            self._current_file_index = -1
-            path = self._matchfilelist[self._current_file_index]
-
-        return path
+        # the pages of the results are the positions of the files
+        # in the flat toc, and the lengths of the texts of the files
+        # are kept to estimate the page of the matches
+        self._text_lengths = {}
+        self._start(_SearchThread(self, fulltext_index))
 
-    def get_search_text(self):
+    def get_current_match(self):
         '''
-        Returns the search text
+        Returns a (file, start, end) tuple with the current match,
+        the offsets are in the text of the file, or None if there
+        are not matches
         '''
-        return self._text
+        if self._current_found_item < 0:
+            return None
+        entry = self.flattoc[self._found_pages[self._current_found_item]]
+        start = self._found_positions[self._current_found_item]
+        return entry, start, start + len(self._text)
 
-    def get_flags(self, forward=True):
+    def get_current_scrollfactor(self):
         '''
-        Returns the search flags
+        Returns the position (fraction) of the current match
+        in the text of the file
         '''
-        flags = WebKit2.FindOptions.NONE
-        if self._case_sensitive:
-            flags = flags | WebKit2.FindOptions.CASE_INSENSITIVE
-        if not forward:
-            flags = flags | WebKit2.FindOptions.BACKWARDS
-        return flags
+        if self._current_found_item < 0:
+            return 0
+        length = self._text_lengths.get(
+            self._found_pages[self._current_found_item], 0)
+        start = self._found_positions[self._current_found_item]
+        return start / max(length, 1)
@@ -19,81 +19,86 @@ class NavPoint(object):
         return self._children
 
 
-class NavMap(object):
-    def __init__(self, opffile, ncxfile, basepath):
-        self._basepath = basepath
-        self._opffile = opffile
-        self._tree = etree.parse(ncxfile)
-        self._root = self._tree.getroot()
-        self._gtktreestore = Gtk.TreeStore(str, str)
-        self._flattoc = []
-
-        self._populate_flattoc()
-        self._populate_toc()
-
-    def _populate_flattoc(self):
-        tree = etree.parse(self._opffile)
-        root = tree.getroot()
+_NCX_NS = '{http://www.daisy.org/z3986/2005/ncx/}'
 
-        itemmap = {}
-        manifest = root.find('.//{http://www.idpf.org/2007/opf}manifest')
-        for element in manifest.iterfind('{http://www.idpf.org/2007/opf}item'):
-            itemmap[element.get('id')] = element
 
-        spine = root.find('.//{http://www.idpf.org/2007/opf}spine')
-        for element in spine.iterfind('{http://www.idpf.org/2007/opf}itemref'):
-            idref = element.get('idref')
-            href = itemmap[idref].get('href')
-            self._flattoc.append(self._basepath + href)
-
-        self._opffile.close()
+class NavMap(object):
+    def __init__(self, ncxfile, basepath, flattoc):
+        self._basepath = basepath
+        self._gtktreestore = None
+        self._link_iters = {}
+        self._flattoc = flattoc
+        self._navpoints = []
+
+        self._parse_ncx(ncxfile)
+
+    def _parse_ncx(self, ncxfile):
+        # the nav points are read while the file is parsed,
+        # the elements are cleared when they are not needed
+        stack = []
+        for event, element in etree.iterparse(ncxfile,
+                                              events=('start', 'end')):
+            if element.tag == _NCX_NS + 'navPoint':
+                if event == 'start':
+                    stack.append(['', '', []])
+                    continue
+                title, content, children = stack.pop()
+                navpoint = NavPoint(title, content, children)
+                if stack:
+                    stack[-1][2].append(navpoint)
+                else:
+                    self._navpoints.append(navpoint)
+                element.clear()
+            elif event == 'start' or not stack:
+                continue
+            elif element.tag == _NCX_NS + 'navLabel':
+                if not stack[-1][0]:
+                    stack[-1][0] = element.findtext(_NCX_NS + 'text')
+            elif element.tag == _NCX_NS + 'content':
+                if not stack[-1][1] and element.get('src') is not None:
+                    stack[-1][1] = self._basepath + element.get('src')
 
     def _populate_toc(self):
-        navmap = self._root.find(
-            '{http://www.daisy.org/z3986/2005/ncx/}navMap')
-        for navpoint in navmap.iterfind(
-                './{http://www.daisy.org/z3986/2005/ncx/}navPoint'):
+        self._gtktreestore = Gtk.TreeStore(str, str)
+        for navpoint in self._navpoints:
             self._process_navpoint(navpoint)
 
-    def _gettitle(self, navpoint):
-        text = navpoint.find(
-            './{http://www.daisy.org/z3986/2005/ncx/}' +
-            'navLabel/{http://www.daisy.org/z3986/2005/ncx/}text')
-        return text.text
-
-    def _getcontent(self, navpoint):
-        text = navpoint.find(
-            './{http://www.daisy.org/z3986/2005/ncx/}content')
-        if text is not None:
-            return self._basepath + text.get('src')
-        else:
-            return ""
-
     def _process_navpoint(self, navpoint, parent=None):
-        title = self._gettitle(navpoint)
-        content = self._getcontent(navpoint)
-
-        # print title, content
-
-        iter = self._gtktreestore.append(parent, [title, content])
-        # self._flattoc.append((title, content))
-
-        childnavpointlist = list(navpoint.iterfind(
-            './{http://www.daisy.org/z3986/2005/ncx/}navPoint'))
-
-        if len(childnavpointlist):
-            for childnavpoint in childnavpointlist:
-                self._process_navpoint(childnavpoint, parent=iter)
-        else:
-            return
+        content = navpoint.get_contentsrc()
+        iter = self._gtktreestore.append(
+            parent, [navpoint.get_label(), content])
+        # the iters of a TreeStore persist, the first nav point
+        # of every link is used to show the current position
+        if content not in self._link_iters:
+            self._link_iters[content] = iter
+
+        for childnavpoint in navpoint.get_children():
+            self._process_navpoint(childnavpoint, parent=iter)
+
+    def has_navpoints(self):
+        '''
+        Returns True if the table of contents is not empty
+        '''
+        return len(self._navpoints) > 0
 
     def get_gtktreestore(self):
         '''
         Returns a GtkTreeModel representation of the
-        Epub table of contents
+        Epub table of contents, it is created the first time
+        it is requested
         '''
+        if self._gtktreestore is None:
+            self._populate_toc()
         return self._gtktreestore
 
+    def get_link_iter(self, link):
+        '''
+        Returns the iter of the GtkTreeModel for the link,
+        or None if it is not in the table of contents
+        '''
+        self.get_gtktreestore()
+        return self._link_iters.get(link)
+
     def get_flattoc(self):
         '''
         Returns a flat (linear) list of files to be
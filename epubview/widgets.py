@@ -6,9 +6,67 @@ except:
 gi.require_version('Gtk', '3.0')
 
 from gi.repository import WebKit2
-from gi.repository import Gtk
 from gi.repository import Gdk
 from gi.repository import GObject
+from gi.repository import GLib
+from gi.repository import Gio
+
+import json
+import logging
+
+from .epub import URI_SCHEME
+from .epub import get_document
+
+_uri_scheme_registered = False
+
+_PAGE_HEIGHT_JS = '''
+    (function(){
+        if (document.body == null) {
+            return 0;
+        } else {
+            return Math.max(document.body.scrollHeight,
+                document.body.offsetHeight,
+                document.documentElement.clientHeight,
+                document.documentElement.scrollHeight,
+                document.documentElement.offsetHeight);
+        };
+    })()
+'''
+
+
+def _int_result_cb(view, result, callback, *args):
+    try:
+        value = int(float(result))
+    except (TypeError, ValueError):
+        value = 0
+    callback(view, value, *args)
+
+
+def _uri_scheme_request_cb(request):
+    document, entry = get_document(request.get_uri())
+    try:
+        if document is None:
+            raise KeyError(entry)
+        data = document.read_file(entry)
+    except KeyError:
+        request.finish_error(GLib.Error.new_literal(
+            Gio.io_error_quark(), 'File not found %s' % request.get_uri(),
+            Gio.IOErrorEnum.NOT_FOUND))
+        return
+    stream = Gio.MemoryInputStream.new_from_bytes(GLib.Bytes.new(data))
+    request.finish(stream, len(data), document.get_mimetype(entry))
+
+
+def _register_uri_scheme():
+    '''
+    The files of the epub are loaded from the zip when requested by
+    the web views, instead of extracting all of them in a directory
+    '''
+    global _uri_scheme_registered
+    if not _uri_scheme_registered:
+        WebKit2.WebContext.get_default().register_uri_scheme(
+            URI_SCHEME, _uri_scheme_request_cb)
+        _uri_scheme_registered = True
 
 
 class _WebView(WebKit2.WebView):
@@ -27,6 +85,8 @@ class _WebView(WebKit2.WebView):
     }
 
     def __init__(self, **kwargs):
+        _register_uri_scheme()
+
         cm = WebKit2.UserContentManager()
 
         cm.register_script_message_handler('scrolled')
@@ -45,6 +105,15 @@ class _WebView(WebKit2.WebView):
             'script-message-received::scrolled_bottom',
             lambda cm, result: self.emit('scrolled-bottom'))
 
+        # the offsets of the selection are sent before
+        # the selection change, then are available when
+        # selection-changed is emitted
+        self._selection_offsets = None
+        cm.register_script_message_handler('selection_offsets')
+        cm.connect(
+            'script-message-received::selection_offsets',
+            self.__selection_offsets_cb)
+
         cm.register_script_message_handler('selection_changed')
         cm.connect(
             'script-message-received::selection_changed',
@@ -54,13 +123,119 @@ class _WebView(WebKit2.WebView):
         cm.add_script(
             WebKit2.UserScript(
                 '''
+var scrollPending = false;
 window.addEventListener("scroll", function(){
-    var handler = window.webkit.messageHandlers.scrolled;
-    handler.postMessage(window.scrollY);
+    // the position is sent once by frame while scrolling
+    if (scrollPending)
+        return;
+    scrollPending = true;
+    window.requestAnimationFrame(function() {
+        scrollPending = false;
+        var handler = window.webkit.messageHandlers.scrolled;
+        handler.postMessage(window.scrollY);
+    });
 });
+function selectionOffsets() {
+    // the positions are offsets in the text of the body,
+    // they don't change when the highlights are added
+    var selObj = window.getSelection();
+    if (selObj.rangeCount < 1 || document.body == null)
+        return "";
+    var range = selObj.getRangeAt(0);
+    var before = document.createRange();
+    before.setStart(document.body, 0);
+    before.setEnd(range.startContainer, range.startOffset);
+    var start = before.toString().length;
+    return start + "," + (start + range.toString().length);
+};
+function setHighlights(ranges) {
+    var marks = document.querySelectorAll("span.read-highlight");
+    for (var i = 0; i < marks.length; i++) {
+        var parent = marks[i].parentNode;
+        while (marks[i].firstChild)
+            parent.insertBefore(marks[i].firstChild, marks[i]);
+        parent.removeChild(marks[i]);
+        parent.normalize();
+    };
+    if (document.body == null)
+        return;
+    var nodes = [];
+    var starts = [];
+    var pos = 0;
+    var walker = document.createTreeWalker(
+        document.body, NodeFilter.SHOW_TEXT, null, false);
+    while (walker.nextNode()) {
+        nodes.push(walker.currentNode);
+        starts.push(pos);
+        pos += walker.currentNode.length;
+    };
+    // the ranges are sorted and don't overlap, going backwards
+    // the text nodes split keep the start of the text
+    var n = nodes.length - 1;
+    for (var r = ranges.length - 1; r >= 0; r--) {
+        while (n >= 0 && starts[n] >= ranges[r][1])
+            n--;
+        for (var j = n; j >= 0 && starts[j] + nodes[j].length > ranges[r][0];
+             j--) {
+            var text = nodes[j];
+            var init = Math.max(ranges[r][0] - starts[j], 0);
+            var end = Math.min(ranges[r][1] - starts[j], text.length);
+            if (end < text.length)
+                text.splitText(end);
+            if (init > 0)
+                text = text.splitText(init);
+            var span = document.createElement("span");
+            span.className = "read-highlight";
+            span.style.backgroundColor = "yellow";
+            text.parentNode.insertBefore(span, text);
+            span.appendChild(text);
+        };
+    };
+};
+function selectText(start, text) {
+    // the text in the web view can be a little different than
+    // the text read from the file, the nearest match is selected
+    if (document.body == null)
+        return -1;
+    var nodes = [];
+    var starts = [];
+    var content = "";
+    var walker = document.createTreeWalker(
+        document.body, NodeFilter.SHOW_TEXT, null, false);
+    while (walker.nextNode()) {
+        nodes.push(walker.currentNode);
+        starts.push(content.length);
+        content += walker.currentNode.data;
+    };
+    content = content.toLowerCase();
+    var found = content.indexOf(text, start);
+    var before = content.lastIndexOf(text, start);
+    if (before > -1 && (found < 0 || start - before < found - start))
+        found = before;
+    if (found < 0)
+        return -1;
+    var range = document.createRange();
+    for (var i = 0; i < nodes.length; i++) {
+        if (starts[i] + nodes[i].length > found) {
+            range.setStart(nodes[i], found - starts[i]);
+            break;
+        };
+    };
+    for (; i < nodes.length; i++) {
+        if (starts[i] + nodes[i].length >= found + text.length) {
+            range.setEnd(nodes[i], found + text.length - starts[i]);
+            break;
+        };
+    };
+    var selObj = window.getSelection();
+    selObj.removeAllRanges();
+    selObj.addRange(range);
+    return Math.round(range.getBoundingClientRect().top + window.scrollY);
+};
 document.addEventListener("selectionchange", function() {
-    var handler = window.webkit.messageHandlers.selection_changed;
-    handler.postMessage(window.getSelection() != '');
+    var handlers = window.webkit.messageHandlers;
+    handlers.selection_offsets.postMessage(selectionOffsets());
+    handlers.selection_changed.postMessage(window.getSelection() != '');
 });
                 ''',
                 WebKit2.UserContentInjectedFrames.ALL_FRAMES,
@@ -78,6 +253,27 @@ body { overflow: hidden; }
         WebKit2.WebView.__init__(self, user_content_manager=cm, **kwargs)
         self.get_settings().set_enable_write_console_messages_to_stdout(True)
 
+    def __selection_offsets_cb(self, cm, result):
+        offsets = result.get_js_value().to_string()
+        if offsets:
+            self._selection_offsets = [int(n) for n in offsets.split(',')]
+        else:
+            self._selection_offsets = None
+
+    def get_selection_offsets(self):
+        '''
+        Returns [start, end] offsets of the selection, or the cursor,
+        in the text of the body of the page, or None
+        '''
+        return self._selection_offsets
+
+    def set_highlights(self, highlights):
+        '''
+        Highlights the [start, end] ranges of text in the page,
+        replacing the highlights shown before
+        '''
+        self.run_javascript('setHighlights(%s);' % json.dumps(highlights))
+
     def do_context_menu(self, context_menu, event, hit_test_result):
         # nope nope nope nopenopenopenenope
         return True
@@ -96,41 +292,33 @@ body { overflow: hidden; }
             elif x < view_width * 1 / 4:
                 self.emit('touch-change-page', False)
 
-    def _execute_script_sync(self, js):
+    def execute_script(self, js, callback=None, *args):
         '''
-        This sad function aims to provide synchronous script execution like
-        WebKit-1.0's WebView.execute_script() to ease porting.
+        Runs the script without waiting for it. When the script finish,
+        callback(view, result, *args) is called with the result of the
+        script as a string, or None if the script failed.
         '''
-        res = ["0"]
-
-        def callback(self, task, user_data):
-            Gtk.main_quit()
-            result = self.run_javascript_finish(task)
-            if result is not None:
-                res[0] = result.get_js_value().to_string()
+        def script_cb(self, task, user_data):
+            result = None
+            try:
+                js_result = self.run_javascript_finish(task)
+            except GLib.Error as e:
+                logging.error('Error running script: %s', e)
+            else:
+                if js_result is not None:
+                    result = js_result.get_js_value().to_string()
+            if callback is not None:
+                callback(self, result, *args)
 
-        self.run_javascript(js, None, callback, None)
-        Gtk.main()
-        return res[0]
+        self.run_javascript(js, None, script_cb, None)
 
-    def get_page_height(self):
+    def get_page_height(self, callback, *args):
         '''
         Gets height (in pixels) of loaded (X)HTML page.
-        This is done via javascript at the moment
-        '''
-        return int(self._execute_script_sync('''
-            (function(){
-                if (document.body == null) {
-                    return 0;
-                } else {
-                    return Math.max(document.body.scrollHeight,
-                        document.body.offsetHeight,
-                        document.documentElement.clientHeight,
-                        document.documentElement.scrollHeight,
-                        document.documentElement.offsetHeight);
-                };
-            })()
-        '''))
+        This is done via javascript, callback(view, height, *args)
+        is called when the height is available
+        '''
+        self.execute_script(_PAGE_HEIGHT_JS, _int_result_cb, callback, *args)
 
     def add_bottom_padding(self, incr):
         '''
@@ -148,13 +336,25 @@ body { overflow: hidden; }
     def go_to_link(self, id_link):
         self.run_javascript('window.location.href = "%s";' % id_link)
 
-    def get_vertical_position_element(self, id_link):
+    def select_text(self, start, text, callback, *args):
+        '''
+        Selects the text nearest to the start offset in the text
+        of the body, callback(view, position, *args) is called
+        with the vertical position of the selection, or -1
+        if the text was not found
+        '''
+        self.execute_script(
+            'selectText(%d, %s);' % (start, json.dumps(text.lower())),
+            _int_result_cb, callback, *args)
+
+    def get_vertical_position_element(self, id_link, callback, *args):
         '''
-        Get the vertical position of a element, in pixels
+        Get the vertical position of a element, in pixels,
+        callback(view, position, *args) is called when it is available
         '''
         # remove the first '#' char
         id_link = id_link[1:]
-        return int(self._execute_script_sync('''
+        self.execute_script('''
             (function(id_link){
                 var obj = document.getElementById(id_link);
                 var top = 0;
@@ -171,7 +371,7 @@ body { overflow: hidden; }
                 }
                 return top;
             })("%s")
-        ''' % id_link))
+        ''' % id_link, _int_result_cb, callback, *args)
 
     def scroll_to(self, to):
         '''
@@ -0,0 +1,200 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import array
+import threading
+
+from gi.repository import GObject
+
+# number of search results sent together to the main thread
+SEARCH_BATCH_SIZE = 500
+
+
+def find_all(text, sub):
+    '''
+    Returns an array with the positions of all the matches
+    of sub in text, including the overlapped matches
+    '''
+    positions = array.array('i')
+    found = text.find(sub)
+    while found > -1:
+        positions.append(found)
+        found = text.find(sub, found + 1)
+    return positions
+
+
+class FindJob(GObject.GObject):
+    '''
+    Base class of the search jobs of the text and epub books.
+    The results are stored as two compact arrays, with the page
+    and the position in the text of the page of every match.
+    '''
+
+    __gsignals__ = {
+        'updated': (GObject.SignalFlags.RUN_FIRST, GObject.TYPE_NONE, ([])),
+        'results-changed': (GObject.SignalFlags.RUN_FIRST,
+                            GObject.TYPE_NONE, ([])), }
+
+    def __init__(self, start_page, n_pages, text, case_sensitive=False):
+        GObject.GObject.__init__(self)
+
+        self._finished = False
+        self._start_page = start_page
+        self._n_pages = n_pages
+        self._text = text
+        self._case_sensitive = case_sensitive
+        self._found_pages = array.array('i')
+        self._found_positions = array.array('i')
+        self._current_found_item = -1
+        self.threads = []
+
+    def _start(self, search_thread):
+        self.threads.append(search_thread)
+        search_thread.start()
+
+    def cancel(self):
+        '''
+        Cancels the search job
+        '''
+        for s_thread in self.threads:
+            s_thread.stop()
+
+    def is_finished(self):
+        '''
+        Returns True if the entire search job has been finished
+        '''
+        return self._finished
+
+    def get_search_text(self):
+        '''
+        Returns the search text
+        '''
+        return self._text
+
+    def get_case_sensitive(self):
+        '''
+        Returns True if the search is case-sensitive
+        '''
+        return self._case_sensitive
+
+    def get_n_results(self):
+        '''
+        Returns the number of matches found until now
+        '''
+        return len(self._found_pages)
+
+    def _add_results(self, pages, positions):
+        # called in the main thread with every batch of results
+        first_results = not self._found_pages
+        self._found_pages.extend(pages)
+        self._found_positions.extend(positions)
+        if first_results and self._found_pages:
+            # show the first match, while the search continue
+            self._current_found_item = 0
+            self.emit('updated')
+        self.emit('results-changed')
+        return False
+
+    def _search_finished(self):
+        self._finished = True
+        self.emit('results-changed')
+        return False
+
+    def find_next(self):
+        if not self._found_pages:
+            return
+        self._current_found_item = self._current_found_item + 1
+        if self._current_found_item >= len(self._found_pages):
+            self._current_found_item = 0
+        self.emit('updated')
+
+    def find_previous(self):
+        if not self._found_pages:
+            return
+        self._current_found_item = self._current_found_item - 1
+        if self._current_found_item < 0:
+            self._current_found_item = len(self._found_pages) - 1
+        self.emit('updated')
+
+
+class SearchThread(threading.Thread):
+    '''
+    Base class of the search threads, the subclasses implement
+    _iter_positions(), and the matches are sent in batches
+    to the job in the main thread. If the book is in the full text
+    index, only the pages found by the index are searched.
+    '''
+
+    def __init__(self, obj, fulltext_index=None):
+        threading.Thread.__init__(self)
+        self.obj = obj
+        self._fulltext_index = fulltext_index
+        self.stopthread = threading.Event()
+
+    def _iter_positions(self, text):
+        '''
+        Yields (page, positions) tuples, positions is an array
+        with the offsets of the matches of text in the page
+        '''
+        raise NotImplementedError
+
+    def _iter_index_positions(self, text, pages):
+        '''
+        Yields (page, positions) tuples like _iter_positions(),
+        from the (page, content) tuples found by the full text index
+        '''
+        for page, content in pages:
+            if not self.obj._case_sensitive:
+                content = content.lower()
+            yield page, find_all(content, text)
+
+    def _start_search(self):
+        text = self.obj._text
+        if not self.obj._case_sensitive:
+            text = text.lower()
+        pages = array.array('i')
+        positions = array.array('i')
+        results_sent = False
+        index_pages = None
+        if self._fulltext_index is not None:
+            index_pages = self._fulltext_index.search(self.obj._text)
+        if index_pages is not None:
+            pages_positions = self._iter_index_positions(text, index_pages)
+        else:
+            pages_positions = self._iter_positions(text)
+        try:
+            for page, page_positions in pages_positions:
+                if self.stopthread.is_set():
+                    break
+                pages.extend([page] * len(page_positions))
+                positions.extend(page_positions)
+                if pages and (not results_sent or
+                              len(pages) >= SEARCH_BATCH_SIZE):
+                    GObject.idle_add(self.obj._add_results, pages,
+                                     positions)
+                    pages = array.array('i')
+                    positions = array.array('i')
+                    results_sent = True
+        finally:
+            pages_positions.close()
+
+        if pages:
+            GObject.idle_add(self.obj._add_results, pages, positions)
+        GObject.idle_add(self.obj._search_finished)
+
+    def run(self):
+        self._start_search()
+
+    def stop(self):
+        self.stopthread.set()
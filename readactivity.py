@@ -63,6 +63,7 @@ from sugar3.graphics.objectchooser import FILTER_TYPE_MIME_BY_ACTIVITY
 from sugar3.graphics import style
 
 import emptypanel
+import readcache
 from readtoolbar import EditToolbar
 from readtoolbar import ViewToolbar
 from bookmarkview import BookmarkView
@@ -195,6 +196,9 @@ class ReadActivity(activity.Activity):
 
         self._view = None
         self.dpi = _get_screen_dpi()
+        # the old versions could leave extracted books in the temporary
+        # directory, they are removed once when the activity starts
+        readcache.remove_orphan_tempdirs()
         self._bookmark_view = BookmarkView()
         self._bookmark_view.connect('bookmark-changed',
                                     self._update_bookmark_cb)
@@ -492,6 +496,10 @@ class ReadActivity(activity.Activity):
         if hasattr(self._view, 'get_vertical_pos'):
             scrollbar_pos = self._view.get_vertical_pos()
         if visible:
+            if self._toc_model is None and \
+                    hasattr(self._view, 'get_toc_model'):
+                # the model is created when the navigator is shown
+                self.set_navigator_model(self._view.get_toc_model())
             self._toc_visible = True
             self._update_toc_view = True
             self._toc_select_active_page()
@@ -997,6 +1005,12 @@ class ReadActivity(activity.Activity):
             self._view = evinceadapter.EvinceViewer()
             self._view_toolbar.show_inverted_colors_button()
 
+        # the filehash is needed by the views to store information
+        # related to the document
+        self.filehash = self.metadata.get('filehash', None)
+        if self.filehash is None:
+            self.filehash = get_md5(filepath)
+
         self._view.setup(self)
         self._view.load_document(filepath)
 
@@ -1005,10 +1019,6 @@ class ReadActivity(activity.Activity):
         self._view_toolbar.set_view(self._view)
         self._edit_toolbar.set_view(self._view)
 
-        self.filehash = self.metadata.get('filehash', None)
-        if self.filehash is None:
-            self.filehash = get_md5(filepath)
-
         self._bookmarkmanager = BookmarkManager(self.filehash)
 
         # update bookmarks and highlights with the informaiton
@@ -1167,6 +1177,9 @@ class ReadActivity(activity.Activity):
             self._highlight.set_active(in_bounds)
             self._highlight.handler_unblock(self._highlight_id)
 
+    def _view_pagecount_changed_cb(self, view, pagecount):
+        self._update_nav_buttons(self._view.get_current_page())
+
     def _edit_toolbar_copy_cb(self, button):
         self._view.copy()
 
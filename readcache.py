@@ -0,0 +1,163 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+_logger = logging.getLogger('read-activity')
+
+# the data of every book, like the pagination, is stored in the data
+# directory, in a file named by the hash of the book and one of these
+# extensions
+BOOK_DATA_EXTENSIONS = ('.epubpages', '.pageindex')
+
+# the settings are read from this file in the data directory,
+# with the values by default:
+# book_data_size: bytes used by the data files of the books, the files
+# of the books not read recently are removed when they use more
+# fulltext_index_size: characters of text of the books kept in the full
+# text index, the books not read recently are removed when there is more
+SETTINGS_FILE = 'settings.json'
+DEFAULT_SETTINGS = {'book_data_size': 4 * 1024 * 1024,
+                    'fulltext_index_size': 64 * 1024 * 1024}
+
+# the old versions extracted the books in temporary directories, that
+# were not removed if the activity was closed by a crash
+ORPHAN_TEMPDIR_AGE = 24 * 60 * 60
+
+
+def _get_data_dir():
+    return os.path.join(os.environ['SUGAR_ACTIVITY_ROOT'], 'data')
+
+
+def get_setting(name):
+    '''
+    Returns the value of the setting name in the settings file,
+    or the value by default if it is not set
+    '''
+    default = DEFAULT_SETTINGS[name]
+    try:
+        with open(os.path.join(_get_data_dir(), SETTINGS_FILE), 'r') as f:
+            settings = json.load(f)
+    except (IOError, ValueError):
+        return default
+    if not isinstance(settings, dict):
+        return default
+    value = settings.get(name)
+    if not isinstance(value, type(default)):
+        return default
+    return value
+
+
+def load_book_data(path, key):
+    '''
+    Returns the dict stored in path by save_book_data(), or None if
+    there is no file or it was computed for other book or settings
+    '''
+    try:
+        with open(path, 'r') as f:
+            data = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if not isinstance(data, dict) or data.get('key') != key:
+        return None
+    return data
+
+
+def save_book_data(path, key, data):
+    '''
+    Stores the dict data in path, with the key of the book and settings
+    used to compute it. The file is replaced when it was written
+    completely, to not leave a broken file if the activity is closed.
+    '''
+    data = dict(data, key=key)
+    temp_path = path + '.tmp'
+    try:
+        with open(temp_path, 'w') as f:
+            json.dump(data, f)
+        os.rename(temp_path, path)
+    except IOError as e:
+        _logger.error('Can not save %s: %s', path, e)
+
+
+def trim_book_data(path, max_size=None):
+    '''
+    Marks the data file of a book in path as used, and removes the data
+    files of the books not read recently, when all the files use more
+    than max_size, or the book_data_size setting, and the temporary
+    files not renamed when they were saved
+    '''
+    if max_size is None:
+        max_size = get_setting('book_data_size')
+    if os.path.exists(path):
+        os.utime(path, None)
+
+    data_dir = os.path.dirname(path)
+    data_files = []
+    for file_name in os.listdir(data_dir):
+        file_path = os.path.join(data_dir, file_name)
+        try:
+            if file_name.endswith(tuple(extension + '.tmp' for extension
+                                        in BOOK_DATA_EXTENSIONS)):
+                os.remove(file_path)
+            elif file_name.endswith(BOOK_DATA_EXTENSIONS):
+                stat = os.stat(file_path)
+                data_files.append((stat.st_mtime, stat.st_size, file_path))
+        except OSError as e:
+            _logger.error('Can not check the data file %s: %s',
+                          file_path, e)
+
+    used_size = 0
+    for mtime, size, file_path in sorted(data_files, reverse=True):
+        used_size += size
+        if used_size > max_size and file_path != path:
+            _logger.debug('Removing the data file %s', file_path)
+            try:
+                os.remove(file_path)
+            except OSError as e:
+                _logger.error('Can not remove the data file %s: %s',
+                              file_path, e)
+
+
+def remove_orphan_tempdirs():
+    '''
+    Removes the books extracted in the temporary directory
+    by the old versions, if they were not used recently
+    '''
+    temp_dir = tempfile.gettempdir()
+    try:
+        file_names = os.listdir(temp_dir)
+    except OSError:
+        return
+    for file_name in file_names:
+        path = os.path.join(temp_dir, file_name)
+        try:
+            if not file_name.startswith('tmp') or \
+                    not os.path.isdir(path) or \
+                    os.stat(path).st_uid != os.getuid() or \
+                    time.time() - os.stat(path).st_mtime < \
+                    ORPHAN_TEMPDIR_AGE or \
+                    not os.path.isdir(os.path.join(path, 'META-INF')):
+                continue
+            with open(os.path.join(path, 'mimetype'), 'rb') as f:
+                if not f.read().startswith(b'application/epub+zip'):
+                    continue
+        except (IOError, OSError):
+            continue
+        _logger.debug('Removing the extracted book %s', path)
+        shutil.rmtree(path, ignore_errors=True)
@@ -23,14 +23,21 @@ import sqlite3
 import time
 import base64
 import json
+import threading
+from bisect import bisect_left
+from bisect import bisect_right
 
 from gi.repository import GObject
 from sugar3 import profile
 
+from readcache import get_setting
 from readbookmark import Bookmark
 
 _logger = logging.getLogger('read-activity')
 
+# maximum number of pages of a book in the full text index
+FULLTEXT_MAX_PAGES = 1 << 20
+
 
 def _init_db():
     dbdir = os.path.join(os.environ['SUGAR_ACTIVITY_ROOT'], 'data')
@@ -94,6 +101,88 @@ def _init_db_previews(conn):
     conn.commit()
 
 
+def _init_db_fulltext(conn):
+    '''
+    Returns False if the sqlite library does not support
+    full text search of substrings
+    '''
+    try:
+        # the trigram tokenizer finds any text of 3 or more characters,
+        # also inside the words
+        conn.execute('CREATE VIRTUAL TABLE IF NOT EXISTS FULLTEXT_PAGES ' +
+                     "USING fts5(content, tokenize='trigram')")
+    except sqlite3.OperationalError as e:
+        _logger.error('Full text search not available: %s', e)
+        return False
+    # the rowid of the pages is the id of the book * FULLTEXT_MAX_PAGES
+    # + the page, then the pages of a book are a range of rowids
+    conn.execute('CREATE TABLE IF NOT EXISTS FULLTEXT_PAGES_BOOKS ' +
+                 '(id INTEGER PRIMARY KEY, md5 TEXT UNIQUE, ' +
+                 'size INTEGER, indexed INTEGER, used REAL)')
+    # the index of the previous versions only found whole words
+    try:
+        conn.execute('DROP TABLE IF EXISTS FULLTEXT')
+        conn.execute('DROP TABLE IF EXISTS FULLTEXT_BOOKS')
+    except sqlite3.OperationalError as e:
+        _logger.error('Can not remove the old full text index: %s', e)
+    conn.commit()
+    return True
+
+
+class _PageHighlights(object):
+    '''
+    The highlights in a page, stored as two sorted lists with the
+    start and end positions of disjoint ranges. Overlapping or adjacent
+    ranges are merged when added, then a position can be found
+    with a binary search.
+    '''
+
+    def __init__(self):
+        self._starts = []
+        self._ends = []
+
+    def __len__(self):
+        return len(self._starts)
+
+    def __iter__(self):
+        for start, end in zip(self._starts, self._ends):
+            yield [start, end]
+
+    def add(self, start, end):
+        '''
+        Adds a range, merging it with the ranges overlapping or
+        adjacent to it. Returns the range stored.
+        '''
+        # the ranges in [first, last) end after the start
+        # and start before the end of the new range
+        first = bisect_left(self._ends, start)
+        last = bisect_right(self._starts, end)
+        if first < last:
+            start = min(start, self._starts[first])
+            end = max(end, self._ends[last - 1])
+        self._starts[first:last] = [start]
+        self._ends[first:last] = [end]
+        return [start, end]
+
+    def remove(self, start, end):
+        i = bisect_left(self._starts, start)
+        if i < len(self._starts) and self._starts[i] == start and \
+                self._ends[i] == end:
+            del self._starts[i]
+            del self._ends[i]
+            return True
+        return False
+
+    def find(self, start, end):
+        '''
+        Returns the range including the range start, end or None
+        '''
+        i = bisect_right(self._starts, start) - 1
+        if i >= 0 and self._ends[i] >= end:
+            return [self._starts[i], self._ends[i]]
+        return None
+
+
 class BookmarkManager(GObject.GObject):
 
     __gsignals__ = {
@@ -118,7 +207,7 @@ class BookmarkManager(GObject.GObject):
 
         self._bookmarks = []
         self._populate_bookmarks()
-        self._highlights = {0: []}
+        self._highlights = {}
         self._populate_highlights()
 
         self._user = profile.get_nick_name()
@@ -260,11 +349,15 @@ class BookmarkManager(GObject.GObject):
         try:
             return self._highlights[page]
         except KeyError:
-            self._highlights[page] = []
+            self._highlights[page] = _PageHighlights()
             return self._highlights[page]
 
     def get_all_highlights(self):
-        return self._highlights
+        all_highlights = {}
+        for page, highlights in self._highlights.items():
+            if highlights:
+                all_highlights[page] = list(highlights)
+        return all_highlights
 
     def update_highlights(self, highlights_dict):
         for page in list(highlights_dict.keys()):
@@ -273,26 +366,41 @@ class BookmarkManager(GObject.GObject):
             highlights_in_page = highlights_dict[page]
             page = int(page)
             highlights_stored = self.get_highlights(page)
+            new_highlights = []
             for highlight_tuple in highlights_in_page:
-                if highlight_tuple not in highlights_stored:
-                    self.add_highlight(page, highlight_tuple)
+                if highlights_stored.find(highlight_tuple[0],
+                                          highlight_tuple[1]) is None:
+                    new_highlights.append(highlight_tuple)
+            if new_highlights:
+                self.add_highlights(page, new_highlights)
 
     def add_highlight(self, page, highlight_tuple):
-        logging.debug('Adding hg page %d %s' % (page, highlight_tuple))
-        self.get_highlights(page).append(highlight_tuple)
-
-        t = (self._filehash, page, highlight_tuple[0], highlight_tuple[1])
-        self._conn.execute('insert into highlights values ' +
-                           '(?, ?, ?, ?)', t)
+        self.add_highlights(page, [highlight_tuple])
+
+    def add_highlights(self, page, highlights_list):
+        highlights = self.get_highlights(page)
+        for highlight_tuple in highlights_list:
+            logging.debug('Adding hg page %d %s' % (page, highlight_tuple))
+            init_pos, end_pos = highlights.add(highlight_tuple[0],
+                                               highlight_tuple[1])
+            # the merged highlights are replaced by the new range
+            t = (self._filehash, page, init_pos, end_pos)
+            self._conn.execute(
+                'delete from highlights ' +
+                'where md5=? and page=? and init_pos>=? and end_pos<=?', t)
+            self._conn.execute('insert into highlights values ' +
+                               '(?, ?, ?, ?)', t)
         self._conn.commit()
 
     def del_highlight(self, page, highlight_tuple):
-        self._highlights[page].remove(highlight_tuple)
+        self.get_highlights(page).remove(highlight_tuple[0],
+                                         highlight_tuple[1])
+        # remove also the overlapped rows stored before the merge
         t = (self._filehash, page, highlight_tuple[0],
              highlight_tuple[1])
         self._conn.execute(
             'delete from highlights ' +
-            'where md5=? and page=? and init_pos=? and end_pos=?', t)
+            'where md5=? and page=? and init_pos>=? and end_pos<=?', t)
         self._conn.commit()
 
     def _populate_highlights(self):
@@ -304,5 +412,197 @@ class BookmarkManager(GObject.GObject):
             page = row[1]
             init_pos = row[2]
             end_pos = row[3]
-            highlight_tuple = [init_pos, end_pos]
-            self.get_highlights(page).append(highlight_tuple)
+            self.get_highlights(page).add(init_pos, end_pos)
+
+
+class FullTextIndex(object):
+    '''
+    Full text index of the content of the books, shared by all the books
+    opened. The index is created in a background thread, and after that,
+    the searches are answered by the database without reading the book.
+    The books not read recently are removed from the index when the text
+    of all the books is bigger than the fulltext_index_size setting.
+    '''
+
+    def __init__(self, filehash):
+        self._filehash = filehash
+
+        self._dbpath = _init_db()
+
+        assert self._dbpath is not None
+
+        conn = sqlite3.connect(self._dbpath)
+        self._available = _init_db_fulltext(conn)
+        self._book_id = None
+        self._indexed = False
+        if self._available:
+            conn.execute('insert or ignore into fulltext_pages_books ' +
+                         '(md5, size, indexed) values (?, 0, 0)',
+                         (self._filehash, ))
+            conn.execute('update fulltext_pages_books set used=? ' +
+                         'where md5=?', (time.time(), self._filehash))
+            conn.commit()
+            row = conn.execute('select id, indexed from ' +
+                               'fulltext_pages_books where md5=?',
+                               (self._filehash, )).fetchone()
+            self._book_id, self._indexed = row[0], bool(row[1])
+        conn.close()
+        self._thread = None
+
+    def is_indexed(self):
+        return self._indexed
+
+    def build(self, pages):
+        '''
+        Index the content of the book in a background thread.
+        pages: iterable of (page, text) tuples, used in the thread
+        '''
+        if not self._available or self._indexed or self._thread is not None:
+            return
+        self._thread = _FullTextIndexThread(self, pages)
+        self._thread.start()
+
+    def cancel(self):
+        if self._thread is not None:
+            self._thread.stop()
+
+    def _index_finished(self):
+        self._thread = None
+        self._indexed = True
+        return False
+
+    def search(self, text):
+        '''
+        Returns an iterator of (page, content) tuples, ordered by page,
+        with the pages containing text, not case sensitive, or None if
+        the index can't be used and the book must be read.
+        Is called in the search thread, the pages are read while
+        the iterator is used.
+        '''
+        if not self._indexed or len(text) < 3:
+            # the trigram tokenizer does not find shorter texts
+            return None
+        try:
+            conn = sqlite3.connect(self._dbpath, timeout=30)
+            try:
+                # the book can be removed from the index by other activity
+                row = conn.execute('select indexed from ' +
+                                   'fulltext_pages_books where id=?',
+                                   (self._book_id, )).fetchone()
+                if row is None or not row[0]:
+                    return None
+                first = self._book_id * FULLTEXT_MAX_PAGES
+                rows = conn.execute('select rowid from fulltext_pages ' +
+                                    'where fulltext_pages match ? and ' +
+                                    'rowid between ? and ? order by rowid',
+                                    ('"%s"' % text.replace('"', '""'),
+                                     first, first + FULLTEXT_MAX_PAGES - 1))
+                rowids = [row[0] for row in rows]
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            _logger.error('Error searching in the index: %s', e)
+            return None
+        return self._iter_pages(rowids)
+
+    def _iter_pages(self, rowids):
+        first = self._book_id * FULLTEXT_MAX_PAGES
+        conn = sqlite3.connect(self._dbpath, timeout=30)
+        try:
+            for rowid in rowids:
+                row = conn.execute('select content from fulltext_pages ' +
+                                   'where rowid=?', (rowid, )).fetchone()
+                if row is not None:
+                    yield rowid - first, row[0]
+        finally:
+            conn.close()
+
+
+class _FullTextIndexThread(threading.Thread):
+
+    # number of pages inserted in every transaction, to not lock
+    # the database for a long time
+    _COMMIT_PAGES = 100
+
+    def __init__(self, obj, pages):
+        threading.Thread.__init__(self)
+        # the activity can be closed while indexing
+        self.daemon = True
+        self.obj = obj
+        self._pages = pages
+        self.stopthread = threading.Event()
+
+    def _index(self):
+        # sqlite connections can't be shared between threads
+        conn = sqlite3.connect(self.obj._dbpath, timeout=30)
+        try:
+            return self._index_pages(conn)
+        finally:
+            conn.close()
+
+    def _index_pages(self, conn):
+        book_id = self.obj._book_id
+        first = book_id * FULLTEXT_MAX_PAGES
+        # remove the content of a previous interrupted indexing
+        conn.execute('delete from fulltext_pages where rowid between ? and ?',
+                     (first, first + FULLTEXT_MAX_PAGES - 1))
+        conn.commit()
+        rows = []
+        size = 0
+        for page, text in self._pages:
+            if self.stopthread.is_set():
+                return False
+            if page >= FULLTEXT_MAX_PAGES:
+                _logger.error('The book has too many pages to be indexed')
+                return False
+            rows.append((first + page, text))
+            size += len(text)
+            if len(rows) >= self._COMMIT_PAGES:
+                conn.executemany('insert into fulltext_pages ' +
+                                 '(rowid, content) values (?, ?)', rows)
+                conn.commit()
+                rows = []
+        if self.stopthread.is_set():
+            return False
+        conn.executemany('insert into fulltext_pages ' +
+                         '(rowid, content) values (?, ?)', rows)
+        conn.execute('update fulltext_pages_books set size=?, indexed=1 ' +
+                     'where id=?', (size, book_id))
+        conn.commit()
+        self._remove_old_books(conn)
+        return True
+
+    def _remove_old_books(self, conn):
+        # the books read recently are kept in the index
+        max_size = get_setting('fulltext_index_size')
+        rows = conn.execute('select id, size from fulltext_pages_books ' +
+                            'where id!=? order by used desc',
+                            (self.obj._book_id, ))
+        used_size = 0
+        old_books = []
+        for book_id, size in rows:
+            used_size += size
+            if used_size > max_size:
+                old_books.append(book_id)
+        for book_id in old_books:
+            _logger.debug('Removing the book %s from the index', book_id)
+            first = book_id * FULLTEXT_MAX_PAGES
+            conn.execute('delete from fulltext_pages ' +
+                         'where rowid between ? and ?',
+                         (first, first + FULLTEXT_MAX_PAGES - 1))
+            conn.execute('delete from fulltext_pages_books where id=?',
+                         (book_id, ))
+            conn.commit()
+
+    def run(self):
+        try:
+            indexed = self._index()
+        except Exception as e:
+            # the book can be closed while indexing
+            _logger.error('Error indexing the book: %s', e)
+            indexed = False
+        if indexed:
+            GObject.idle_add(self.obj._index_finished)
+
+    def stop(self):
+        self.stopthread.set()
@@ -26,6 +26,8 @@ from sugar3.graphics.toggletoolbutton import ToggleToolButton
 from sugar3.graphics import iconentry
 from sugar3.activity.widgets import EditToolbar as BaseEditToolbar
 
+from findjob import FindJob
+
 
 class EditToolbar(BaseEditToolbar):
 
@@ -37,6 +39,7 @@ class EditToolbar(BaseEditToolbar):
         self._view = None
 
         self._find_job = None
+        self._find_results_handler = None
 
         search_item = Gtk.ToolItem()
 
@@ -71,6 +74,13 @@ class EditToolbar(BaseEditToolbar):
         self.insert(self._next, -1)
         self._next.show()
 
+        results_item = Gtk.ToolItem()
+        self._results_label = Gtk.Label()
+        results_item.add(self._results_label)
+        self._results_label.show()
+        self.insert(results_item, -1)
+        results_item.show()
+
         separator = Gtk.SeparatorToolItem()
         separator.show()
         self.insert(separator, -1)
@@ -90,7 +100,11 @@ class EditToolbar(BaseEditToolbar):
         if not self._find_job.is_finished():
             self._find_job.cancel()
         self._find_job.disconnect(self._find_updated_handler)
+        if self._find_results_handler is not None:
+            self._find_job.disconnect(self._find_results_handler)
+            self._find_results_handler = None
         self._find_job = None
+        self._results_label.set_text('')
 
     def _search_find_first(self):
         self._clear_find_job()
@@ -98,6 +112,10 @@ class EditToolbar(BaseEditToolbar):
         if text != "":
             self._find_job, self._find_updated_handler = \
                 self._view.setup_find_job(text, self._find_updated_cb)
+            # the number of matches is known in the text and epub books
+            if isinstance(self._find_job, FindJob):
+                self._find_results_handler = self._find_job.connect(
+                    'results-changed', self._find_results_changed_cb)
         else:
             # FIXME: highlight nothing
             pass
@@ -139,6 +157,9 @@ class EditToolbar(BaseEditToolbar):
     def _find_updated_cb(self, job, page=None):
         self._view.find_changed(job, page)
 
+    def _find_results_changed_cb(self, job):
+        self._results_label.set_text(_('%d found') % job.get_n_results())
+
     def _find_prev_cb(self, button):
         if self._search_entry_changed:
             self._search_find_last()
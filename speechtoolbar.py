@@ -14,7 +14,10 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
+import array
+import re
 from gettext import gettext as _
+from xml.sax.saxutils import escape
 
 from gi.repository import Gtk
 
@@ -22,6 +25,41 @@ from sugar3.graphics.toolbutton import ToolButton
 from sugar3.graphics.toggletoolbutton import ToggleToolButton
 from sugar3.speech import SpeechManager
 
+# number of words sent to the speech engine every time
+SPEECH_WINDOW_SIZE = 50
+
+# the words read by the text to speech are separated by these chars
+_WORD_RE = re.compile(r'[^ \n\r_\[\]{}|<>*+/\\]+')
+
+
+def split_words(text):
+    '''
+    Returns two arrays with the start and end offsets
+    of the words in text
+    '''
+    starts = array.array('i')
+    ends = array.array('i')
+    for match in _WORD_RE.finditer(text):
+        starts.append(match.start())
+        ends.append(match.end())
+    return starts, ends
+
+
+def get_marked_words(text, starts, ends, first):
+    '''
+    Returns the SSML text to speak the next SPEECH_WINDOW_SIZE words
+    from the word number first. The words are the text between
+    the offsets in starts and ends, and have a mark named with the
+    word number before them.
+    '''
+    last = min(first + SPEECH_WINDOW_SIZE, len(starts))
+    marked_words = ['<speak>']
+    for i in range(first, last):
+        marked_words.append('<mark name="%d"/>%s' %
+                            (i, escape(text[starts[i]:ends[i]])))
+    marked_words.append('</speak>')
+    return ' '.join(marked_words)
+
 
 class SpeechToolbar(Gtk.Toolbar):
 
@@ -30,6 +68,8 @@ class SpeechToolbar(Gtk.Toolbar):
         self._activity = activity
         self._speech = SpeechManager()
         self._is_paused = False
+        # say_text() emits 'stop' if other text was being spoken
+        self._saying_text = False
 
         # Play button
         self._play_button = ToggleToolButton('media-playback-start')
@@ -46,20 +86,47 @@ class SpeechToolbar(Gtk.Toolbar):
         self.insert(self._stop_button, -1)
         self._stop_button.set_tooltip(_('Stop'))
 
-        self._speech.connect('stop', self._reset_buttons_cb)
+        self._speech.connect('stop', self._speech_stop_cb)
 
     def _reset_buttons_cb(self, widget=None):
+        self._play_button.handler_block_by_func(self._play_toggled_cb)
+        self._play_button.set_active(False)
+        self._play_button.handler_unblock_by_func(self._play_toggled_cb)
         self._play_button.set_icon_name('media-playback-start')
         self._stop_button.set_sensitive(False)
         self._is_paused = False
 
+    def _say_text(self, marked_words):
+        self._saying_text = True
+        try:
+            self._speech.say_text(marked_words)
+        finally:
+            self._saying_text = False
+
+    def _speech_stop_cb(self, speech):
+        if self._saying_text:
+            # the previous text was replaced, not finished
+            return
+        # the text is spoken in windows of words,
+        # if still playing continue with the next window
+        if self._play_button.get_active():
+            marked_words = self._activity._view.get_marked_words()
+            if marked_words is not None:
+                self._say_text(marked_words)
+                return
+        self._activity._view.reset_text_to_speech()
+        self._reset_buttons_cb()
+
     def _play_toggled_cb(self, widget):
         self._stop_button.set_sensitive(True)
         if widget.get_active():
             self._play_button.set_icon_name('media-playback-pause')
             if not self._is_paused:
-                self._speech.say_text(
-                    self._activity._view.get_marked_words())
+                marked_words = self._activity._view.get_marked_words()
+                if marked_words is not None:
+                    self._say_text(marked_words)
+                else:
+                    self._reset_buttons_cb()
             else:
                 self._speech.restart()
         else:
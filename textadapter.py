@@ -1,16 +1,43 @@
 import os
+import sys
+import mmap
+import collections
+import array
+import struct
 import zipfile
 import logging
 from gi.repository import Gtk
 from gi.repository import Gdk
 from gi.repository import Pango
 from gi.repository import GObject
-import threading
 
 from sugar3 import mime
 from sugar3.graphics import style
 
+from findjob import FindJob
+from findjob import SearchThread
+from readcache import load_book_data
+from readcache import save_book_data
+from readcache import trim_book_data
+from readdb import FullTextIndex
+from speechtoolbar import get_marked_words
+from speechtoolbar import SPEECH_WINDOW_SIZE
+from speechtoolbar import split_words
+
 PAGE_SIZE = 38
+LINE_WIDTH = 80
+
+# bump when the way the page index is computed changes,
+# to invalidate the indexes already stored
+PAGE_INDEX_VERSION = 2
+
+# number of pages calculated in every step of the background pagination
+PAGINATION_STEP = 50
+
+# number of rendered pages kept in memory
+PAGE_CACHE_SIZE = 16
+
+_ZIP_LOCAL_HEADER_SIZE = 30
 
 
 # remove hard line breaks, apply a simple logic to try identify
@@ -22,6 +49,165 @@ def _clean_text(line):
     return line
 
 
+def _find_next_page(text_store, position):
+    '''
+    Returns the position of the page following the page starting
+    at position, or None if it is the last page
+    '''
+    linecount = 0
+    while True:
+        line, position = text_store.readline(position)
+        if not line:
+            return None
+        line_increment = (len(line) // LINE_WIDTH) + 1
+        linecount = linecount + line_increment
+        if linecount >= PAGE_SIZE:
+            return position
+
+
+def _read_page(text_store, position):
+    '''
+    Returns the text of the page starting at position, as displayed
+    '''
+    linecount = 0
+    lines = []
+    while linecount < PAGE_SIZE:
+        line, position = text_store.readline(position)
+        if not line:
+            break
+        line = _clean_text(line)
+        lines.append(line)
+        line_increment = (len(line) // LINE_WIDTH) + 1
+        linecount = linecount + line_increment
+    return ''.join(lines)
+
+
+def _iter_pages(text_store):
+    '''
+    Yields (page, text) tuples with the text of every page of the book
+    '''
+    page = 0
+    position = 0
+    while position is not None:
+        yield page, _read_page(text_store, position)
+        position = _find_next_page(text_store, position)
+        page = page + 1
+
+
+def _load_page_index(index_path, key):
+    '''
+    Returns the page index stored in index_path, or None if there is
+    no index or it was computed for other file or parameters
+    '''
+    data = load_book_data(index_path, key)
+    if data is None:
+        return None
+    page_index = data.get('page_index')
+    if not page_index or page_index[0] != 0:
+        return None
+    return page_index
+
+
+class _TextStore(object):
+    '''
+    Read only access to the text of a book, mapped in memory.
+    There are no shared file cursor, every reader keep his own offsets,
+    then the page rendering and the search can read the text
+    at the same time.
+
+    data: a mmap or bytes object containing the text
+    offset, size: the region of data used, by default all the data
+    file_obj: the file mapped in data, closed with the store
+    '''
+
+    def __init__(self, data, offset=0, size=None, file_obj=None):
+        self._data = data
+        self._offset = offset
+        if size is None:
+            size = len(data) - offset
+        self._size = size
+        self._file = file_obj
+        self._buffer = memoryview(data)[offset:offset + size]
+
+    def get_size(self):
+        return self._size
+
+    def get_text(self, start, end):
+        return str(self._buffer[start:end], 'utf-8', 'replace')
+
+    def readline(self, position):
+        '''
+        Returns the line starting at position and the position of the
+        next line. The line ends are translated to '\n' like in files
+        opened in text mode. At the end of the text, returns an empty line.
+        '''
+        if position >= self._size:
+            return '', self._size
+        start = self._offset + position
+        limit = self._offset + self._size
+        end = self._data.find(b'\n', start, limit)
+        if end == -1:
+            end = limit
+        else:
+            end = end + 1
+        cr = self._data.find(b'\r', start, end)
+        if cr == -1:
+            line_end = end
+            text_end = end
+        elif cr + 2 == end and self._data[end - 1:end] == b'\n':
+            line_end = end
+            text_end = cr
+        else:
+            # old style line end with only a '\r'
+            line_end = cr + 1
+            text_end = cr
+        line = self.get_text(position, text_end - self._offset)
+        if text_end != line_end:
+            line = line + '\n'
+        return line, line_end - self._offset
+
+    def close(self):
+        self._buffer.release()
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        if self._file is not None:
+            self._file.close()
+
+
+def _map_file(file_obj):
+    if os.fstat(file_obj.fileno()).st_size == 0:
+        # empty files can't be mapped
+        return b''
+    return mmap.mmap(file_obj.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _open_text_store(file_name):
+    text_file = open(file_name, 'rb')
+    return _TextStore(_map_file(text_file), file_obj=text_file)
+
+
+def _open_zip_text_store(file_name, zip_file, member_name):
+    '''
+    Returns a store with the text of a member of a zip file,
+    without extract it to the disk
+    '''
+    info = zip_file.getinfo(member_name)
+    if info.compress_type != zipfile.ZIP_STORED or info.flag_bits & 0x1:
+        # compressed members are decompressed to memory
+        return _TextStore(zip_file.read(member_name))
+
+    # stored members are mapped directly from the zip file,
+    # the data is after the local file header
+    zip_file.fp.seek(info.header_offset)
+    header = zip_file.fp.read(_ZIP_LOCAL_HEADER_SIZE)
+    name_length, extra_length = struct.unpack('<2H', header[26:30])
+    data_offset = info.header_offset + _ZIP_LOCAL_HEADER_SIZE + \
+        name_length + extra_length
+    archive = open(file_name, 'rb')
+    return _TextStore(_map_file(archive), data_offset, info.file_size,
+                      archive)
+
+
 class TextViewer(GObject.GObject):
 
     __gsignals__ = {
@@ -30,7 +216,11 @@ class TextViewer(GObject.GObject):
         'page-changed': (GObject.SignalFlags.RUN_FIRST, GObject.TYPE_NONE,
                          ([int, int])),
         'selection-changed': (GObject.SignalFlags.RUN_FIRST, GObject.TYPE_NONE,
-                              ([])), }
+                              ([])),
+        'pagecount-changed': (GObject.SignalFlags.RUN_FIRST,
+                              GObject.TYPE_NONE, ([int])),
+        'paginated': (GObject.SignalFlags.RUN_FIRST, GObject.TYPE_NONE,
+                      ([])), }
 
     def setup(self, activity):
         self._activity = activity
@@ -49,6 +239,8 @@ class TextViewer(GObject.GObject):
                               self._view_buttonrelease_event_cb)
         self.connect('selection-changed',
                      activity._view_selection_changed_cb)
+        self.connect('pagecount-changed',
+                     activity._view_pagecount_changed_cb)
 
         self.textview.set_events(self.textview.get_events() |
                                  Gdk.EventMask.TOUCH_MASK)
@@ -74,8 +266,10 @@ class TextViewer(GObject.GObject):
         self._scrollbar.props.valign = Gtk.Align.FILL
         overlay.add_overlay(self._scrollbar)
         overlay.show_all()
+        overlay.connect('destroy', self._destroy_cb)
 
         activity._hbox.pack_start(overlay, True, True, 0)
+        self._fulltext_index = None
 
         self._font_size = style.zoom(12)
         self.font_desc = Pango.FontDescription("mono %d" % self._font_size)
@@ -91,71 +285,153 @@ class TextViewer(GObject.GObject):
 
         # text to speech initialization
         self.current_word = 0
-        self.word_tuples = []
         self.spoken_word_tag = self.textview.get_buffer().create_tag()
         self.spoken_word_tag.set_property('weight', Pango.Weight.BOLD)
         self.normal_tag = self.textview.get_buffer().create_tag()
         self.normal_tag.set_property('weight', Pango.Weight.NORMAL)
 
+    def _destroy_cb(self, widget):
+        if self._fulltext_index is not None:
+            self._fulltext_index.cancel()
+
     def load_document(self, file_path):
 
         file_name = file_path.replace('file://', '')
         mimetype = mime.get_for_file(file_path)
         if mimetype == 'application/zip':
             logging.debug('opening zip file')
-            self.zf = zipfile.ZipFile(file_path.replace('file://', ''), 'r')
+            self.zf = zipfile.ZipFile(file_name, 'r')
             self.book_files = self.zf.namelist()
-            extract_path = os.path.join(self._activity.get_activity_root(),
-                                        'instance')
-            for book_file in self.book_files:
-                if (book_file != 'annotations.pkl'):
-                    self.zf.extract(book_file, extract_path)
-                    file_name = os.path.join(extract_path, book_file)
-
-        logging.debug('opening file_name %s' % file_name)
-        self._etext_file = open(file_name, 'r')
-
-        self.page_index = [0]
-        pagecount = 0
-        linecount = 0
-        while self._etext_file:
-            line = self._etext_file.readline()
-            if not line:
-                break
-            line_increment = (len(line) // 80) + 1
-            linecount = linecount + line_increment
-            if linecount >= PAGE_SIZE:
-                position = self._etext_file.tell()
-                self.page_index.append(position)
-                linecount = 0
-                pagecount = pagecount + 1
-        self._pagecount = pagecount + 1
-        self.set_current_page(0)
-        self._scrollbar.set_range(0.0, self._pagecount - 1.0)
+            book_file = None
+            for name in self.book_files:
+                if name != 'annotations.pkl' and not name.endswith('/'):
+                    book_file = name
+            logging.debug('opening zip member %s' % book_file)
+            self._text_store = _open_zip_text_store(file_name, self.zf,
+                                                    book_file)
+        else:
+            logging.debug('opening file_name %s' % file_name)
+            self._text_store = _open_text_store(file_name)
+
+        # the page index is stored in the data directory, to avoid
+        # scan all the file again when the book is reopened
+        index_key = {'version': PAGE_INDEX_VERSION,
+                     'filehash': self._activity.filehash,
+                     'file_size': self._text_store.get_size(),
+                     'page_size': PAGE_SIZE,
+                     'line_width': LINE_WIDTH}
+        index_path = os.path.join(self._activity.get_activity_root(),
+                                  'data',
+                                  '%s.pageindex' % self._activity.filehash)
+        trim_book_data(index_path)
+        self._index_path = index_path
+        self._index_key = index_key
+        self._page_cache = collections.OrderedDict()
+        self._prefetch_id = None
+        self._fulltext_index = FullTextIndex(self._activity.filehash)
+        self._pending_page = None
+        self._pending_match = None
+        self.page_index = _load_page_index(index_path, index_key)
         self._scrollbar.set_increments(1.0, 1.0)
+        if self.page_index is None:
+            # the first page is shown as soon as is available,
+            # and the rest of the book is paginated in the background
+            self._paginating = True
+            self.page_index = [0]
+            self._index_position = 0
+            if self._paginate_step():
+                GObject.idle_add(self._paginate_step)
+        else:
+            logging.debug('using stored page index %s', index_path)
+            self._paginating = False
+            self._update_pagecount()
+            self._fulltext_index.build(_iter_pages(self._text_store))
+        self.set_current_page(0)
 
         # TODO: now that sugar3.speech has word signals
         # call self.highlight_next_word on each word
         # call self.reset_text_to_speech at end
 
+    def _paginate_step(self):
+        for i in range(PAGINATION_STEP):
+            position = _find_next_page(self._text_store,
+                                       self._index_position)
+            if position is None:
+                self._finish_pagination()
+                return False
+            self.page_index.append(position)
+            self._index_position = position
+        self._update_pagecount()
+        return True
+
+    def _finish_pagination(self):
+        self._paginating = False
+        save_book_data(self._index_path, self._index_key,
+                       {'page_index': self.page_index})
+        if self._pending_page is not None and \
+                self._pending_page >= len(self.page_index):
+            # the requested page is beyond the end of the book
+            self._pending_page = len(self.page_index) - 1
+        self._update_pagecount()
+        self.emit('paginated')
+        self._fulltext_index.build(_iter_pages(self._text_store))
+
+    def _update_pagecount(self):
+        self._pagecount = len(self.page_index)
+        self._scrollbar.set_range(0.0, self._pagecount - 1.0)
+        self.emit('pagecount-changed', self._pagecount)
+        if self._pending_page is not None and \
+                self._pending_page < self._pagecount:
+            page = self._pending_page
+            self._pending_page = None
+            self.set_current_page(page)
+
     def _show_page(self, page_number):
-        position = self.page_index[page_number]
-        self._etext_file.seek(position)
-        linecount = 0
-        label_text = '\n\n\n'
-        while linecount < PAGE_SIZE:
-            line = self._etext_file.readline()
-            if not line:
-                break
-            else:
-                line = _clean_text(line)
-                label_text = label_text + line
-            line_increment = (len(line) // 80) + 1
-            linecount = linecount + line_increment
+        label_text = self._get_page_text(page_number)
         textbuffer = self.textview.get_buffer()
-        label_text = label_text + '\n\n\n'
         textbuffer.set_text(label_text)
-        self._prepare_text_to_speech(label_text)
+        self.reset_text_to_speech()
+
+        # prepare the previous and next pages when idle,
+        # then turning pages only need update the buffer
+        if self._prefetch_id is not None:
+            GObject.source_remove(self._prefetch_id)
+        self._prefetch_id = GObject.idle_add(self._prefetch_pages,
+                                             page_number)
+
+    def _get_page_entry(self, page_number):
+        # the entries in the cache are lists with the page text
+        # and the words in the page, if were already needed
+        if page_number in self._page_cache:
+            self._page_cache.move_to_end(page_number)
+            return self._page_cache[page_number]
+        label_text = '\n\n\n%s\n\n\n' % _read_page(
+            self._text_store, self.page_index[page_number])
+        entry = [label_text, None]
+        self._page_cache[page_number] = entry
+        if len(self._page_cache) > PAGE_CACHE_SIZE:
+            self._page_cache.popitem(last=False)
+        return entry
+
+    def _get_page_text(self, page_number):
+        return self._get_page_entry(page_number)[0]
+
+    def _get_page_words(self):
+        '''
+        Returns the start and end offsets of the words in the current page,
+        the text is split only when the text to speech need it
+        '''
+        entry = self._get_page_entry(self._current_page)
+        if entry[1] is None:
+            entry[1] = split_words(entry[0])
+        return entry[1]
+
+    def _prefetch_pages(self, page_number):
+        self._prefetch_id = None
+        for page in (page_number + 1, page_number - 1):
+            if 0 <= page < self._pagecount:
+                self._get_page_text(page)
+        return False
 
     def _v_scrollbar_value_changed_cb(self, scrollbar):
         """
@@ -228,22 +504,16 @@ class TextViewer(GObject.GObject):
     def in_highlight(self):
         # Verify if the selection already exist or the cursor
         # is in a highlighted area
-        tuples_list = self._activity._bookmarkmanager.get_highlights(
+        highlights = self._activity._bookmarkmanager.get_highlights(
             self.get_current_page())
 
         selection_tuple = self.get_selection_bounds()
-        in_bounds = False
         highlight_found = None
-        for highlight_tuple in tuples_list:
-            logging.debug('control tuple  %s' % str(highlight_tuple))
-            if selection_tuple:
-                if selection_tuple[0] >= highlight_tuple[0] and \
-                   selection_tuple[1] <= highlight_tuple[1]:
-                    in_bounds = True
-                    highlight_found = highlight_tuple
-                    break
+        if selection_tuple:
+            highlight_found = highlights.find(selection_tuple[0],
+                                              selection_tuple[1])
 
-        return in_bounds, highlight_found
+        return highlight_found is not None, highlight_found
 
     def show_highlights(self, page):
         tuples_list = self._activity._bookmarkmanager.get_highlights(page)
@@ -275,59 +545,36 @@ class TextViewer(GObject.GObject):
         return True
 
     def get_marked_words(self):
-        "Adds a mark between each word of text."
-        i = self.current_word
-        marked_up_text = '<speak> '
-        while i < len(self.word_tuples):
-            word_tuple = self.word_tuples[i]
-            marked_up_text = marked_up_text + \
-                ' <mark name="' + str(i) + '"/>' + word_tuple[2]
-            i = i + 1
-        print(marked_up_text)
-        return marked_up_text + '</speak>'
+        '''
+        Returns the next words of the page to speak, with a mark between
+        each word, or None if all the page was spoken
+        '''
+        starts, ends = self._get_page_words()
+        if self.current_word >= len(starts):
+            return None
+        marked_words = get_marked_words(
+            self._get_page_text(self._current_page), starts, ends,
+            self.current_word)
+        self.current_word = self.current_word + SPEECH_WINDOW_SIZE
+        return marked_words
 
     def reset_text_to_speech(self):
         self.current_word = 0
 
-    def _prepare_text_to_speech(self, page_text):
-        i = 0
-        j = 0
-        word_begin = 0
-        word_end = 0
-        ignore_chars = [' ', '\n', '\r', '_', '[', '{', ']', '}', '|',
-                        '<', '>', '*', '+', '/', '\\']
-        ignore_set = set(ignore_chars)
-        self.word_tuples = []
-        len_page_text = len(page_text)
-        while i < len_page_text:
-            if page_text[i] not in ignore_set:
-                word_begin = i
-                j = i
-                while j < len_page_text and page_text[j] not in ignore_set:
-                    j = j + 1
-                    word_end = j
-                    i = j
-                word_tuple = (word_begin, word_end,
-                              page_text[word_begin: word_end])
-                if word_tuple[2] != '\r':
-                    self.word_tuples.append(word_tuple)
-            i = i + 1
-
     def highlight_next_word(self, word_count):
-        if word_count < len(self.word_tuples):
-            word_tuple = self.word_tuples[word_count]
+        starts, ends = self._get_page_words()
+        if word_count < len(starts):
             textbuffer = self.textview.get_buffer()
-            iterStart = textbuffer.get_iter_at_offset(word_tuple[0])
-            iterEnd = textbuffer.get_iter_at_offset(word_tuple[1])
+            iterStart = textbuffer.get_iter_at_offset(starts[word_count])
+            iterEnd = textbuffer.get_iter_at_offset(ends[word_count])
             bounds = textbuffer.get_bounds()
             textbuffer.apply_tag(self.normal_tag, bounds[0], iterStart)
             textbuffer.apply_tag(self.spoken_word_tag, iterStart, iterEnd)
             v_adjustment = self._sw.get_vadjustment()
             max_pos = v_adjustment.get_upper() - v_adjustment.get_page_size()
             max_pos = max_pos * word_count
-            max_pos = max_pos // len(self.word_tuples)
+            max_pos = max_pos // len(starts)
             v_adjustment.set_value(max_pos)
-            self.current_word = word_count
         return True
 
     def update_metadata(self, activity):
@@ -344,9 +591,18 @@ class TextViewer(GObject.GObject):
                 pass
 
     def set_current_page(self, page):
+        if page >= self._pagecount and self._paginating:
+            # wait until the pagination reach the page
+            self._pending_page = page
+            return
+        self._pending_page = None
         old_page = self._current_page
         self._current_page = page
         self._show_page(self._current_page)
+        if self._pending_match is not None:
+            if self._pending_match[0] == page:
+                self._show_found_text(self._pending_match)
+            self._pending_match = None
         self._scrollbar.handler_block(self._scrollbar_change_value_cb_id)
         self._scrollbar.set_value(self._current_page)
         self._scrollbar.handler_unblock(self._scrollbar_change_value_cb_id)
@@ -395,7 +651,10 @@ class TextViewer(GObject.GObject):
         elif scrolltype == Gtk.ScrollType.START:
             self.set_current_page(0)
         elif scrolltype == Gtk.ScrollType.END:
-            self.set_current_page(self._pagecount - 1)
+            if self._paginating:
+                self.set_current_page(sys.maxsize)
+            else:
+                self.set_current_page(self._pagecount - 1)
 
     def previous_page(self):
         v_adjustment = self._sw.get_vadjustment()
@@ -440,9 +699,10 @@ class TextViewer(GObject.GObject):
         pass
 
     def setup_find_job(self, text, _find_updated_cb):
-        self._find_job = _JobFind(self._etext_file, start_page=0,
+        self._find_job = _JobFind(self._text_store, start_page=0,
                                   n_pages=self._pagecount,
-                                  text=text, case_sensitive=False)
+                                  text=text, case_sensitive=False,
+                                  fulltext_index=self._fulltext_index)
         self._find_updated_handler = self._find_job.connect(
             'updated', _find_updated_cb)
         return self._find_job, self._find_updated_handler
@@ -454,8 +714,10 @@ class TextViewer(GObject.GObject):
         self._find_job.find_previous()
 
     def find_changed(self, job, page):
+        # the match is shown with the page, that can be waiting
+        # for the pagination
+        self._pending_match = job.get_founded_tuple()
         self.set_current_page(job.get_page())
-        self._show_found_text(job.get_founded_tuple())
 
     def _show_found_text(self, founded_tuple):
         textbuffer = self.textview.get_buffer()
@@ -516,149 +778,31 @@ class TextViewer(GObject.GObject):
         return False
 
 
-class _JobFind(GObject.GObject):
-
-    __gsignals__ = {
-        'updated': (GObject.SignalFlags.RUN_FIRST, GObject.TYPE_NONE, ([])), }
-
-    def __init__(self, text_file, start_page, n_pages, text,
-                 case_sensitive=False):
-        GObject.GObject.__init__(self)
-        Gdk.threads_init()
-
-        self._finished = False
-        self._text_file = text_file
-        self._start_page = start_page
-        self._n_pages = n_pages
-        self._text = text
-        self._case_sensitive = case_sensitive
-        self.threads = []
-
-        s_thread = _SearchThread(self)
-        self.threads.append(s_thread)
-        s_thread.start()
-
-    def cancel(self):
-        '''
-        Cancels the search job
-        '''
-        for s_thread in self.threads:
-            s_thread.stop()
-
-    def is_finished(self):
-        '''
-        Returns True if the entire search job has been finished
-        '''
-        return self._finished
-
-    def get_search_text(self):
-        '''
-        Returns the search text
-        '''
-        return self._text
-
-    def get_case_sensitive(self):
-        '''
-        Returns True if the search is case-sensitive
-        '''
-        return self._case_sensitive
-
-    def find_next(self):
-        self.threads[-1].find_next()
+class _JobFind(FindJob):
 
-    def find_previous(self):
-        self.threads[-1].find_previous()
+    def __init__(self, text_store, start_page, n_pages, text,
+                 case_sensitive=False, fulltext_index=None):
+        FindJob.__init__(self, start_page, n_pages, text, case_sensitive)
+        self._text_store = text_store
+        self._start(_SearchThread(self, fulltext_index))
 
     def get_page(self):
-        return self.threads[-1].get_page()
+        return self._found_pages[self._current_found_item]
 
     def get_founded_tuple(self):
-        return self.threads[-1].get_founded_tuple()
-
-
-class _SearchThread(threading.Thread):
-
-    def __init__(self, obj):
-        threading.Thread.__init__(self)
-        self.obj = obj
-        self.stopthread = threading.Event()
-
-    def _start_search(self):
-        pagecount = 0
-        linecount = 0
-        charcount = 0
-        self._found_records = []
-        self._current_found_item = -1
-        self.obj._text_file.seek(0)
-        while self.obj._text_file:
-            line = self.obj._text_file.readline()
-            line = _clean_text(line)
-            line_length = len(line)
-            if not line:
-                break
-            line_increment = (len(line) // 80) + 1
-            linecount = linecount + line_increment
-            positions = self._allindices(line.lower(), self.obj._text.lower())
-            for position in positions:
-                found_pos = charcount + position + 3
-                found_tuple = (pagecount, found_pos,
-                               len(self.obj._text) + found_pos)
-                self._found_records.append(found_tuple)
-                self._current_found_item = 0
-            charcount = charcount + line_length
-            if linecount >= PAGE_SIZE:
-                linecount = 0
-                charcount = 0
-                pagecount = pagecount + 1
-        if self._current_found_item == 0:
-            self.current_found_tuple = \
-                self._found_records[self._current_found_item]
-            self._page = self.current_found_tuple[0]
-
-        Gdk.threads_enter()
-        self.obj._finished = True
-        self.obj.emit('updated')
-        Gdk.threads_leave()
-
-        return False
-
-    def _allindices(self, line, search, listindex=None, offset=0):
-        if listindex is None:
-            listindex = []
-        if (line.find(search) == -1):
-            return listindex
-        else:
-            offset = line.index(search) + offset
-            listindex.append(offset)
-            line = line[(line.index(search) + 1):]
-            return self._allindices(line, search, listindex, offset + 1)
-
-    def run(self):
-        self._start_search()
+        position = self._found_positions[self._current_found_item]
+        return (self.get_page(), position, position + len(self._text))
 
-    def stop(self):
-        self.stopthread.set()
 
-    def find_next(self):
-        self._current_found_item = self._current_found_item + 1
-        if self._current_found_item >= len(self._found_records):
-            self._current_found_item = 0
-        self.current_found_tuple =  \
-            self._found_records[self._current_found_item]
-        self._page = self.current_found_tuple[0]
-        self.obj.emit('updated')
+class _SearchThread(SearchThread):
 
-    def find_previous(self):
-        self._current_found_item = self._current_found_item - 1
-        if self._current_found_item <= 0:
-            self._current_found_item = len(self._found_records) - 1
-        self.current_found_tuple = \
-            self._found_records[self._current_found_item]
-        self._page = self.current_found_tuple[0]
-        self.obj.emit('updated')
+    def _iter_positions(self, text):
+        return self._iter_index_positions(text,
+                                          _iter_pages(self.obj._text_store))
 
-    def get_page(self):
-        return self._page
-
-    def get_founded_tuple(self):
-        return self.current_found_tuple
+    def _iter_index_positions(self, text, pages):
+        for page, positions in SearchThread._iter_index_positions(
+                self, text, pages):
+            # the page is displayed after 3 empty lines
+            yield page, array.array('i', [position + 3 for position
+                                          in positions])